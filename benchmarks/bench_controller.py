@@ -0,0 +1,198 @@
+"""Per-point overhead of TangoVimbaController on simulated cameras.
+
+Drives the controller through the calls the Pool makes for every point of a
+software triggered step scan (state, load, start, state polling, read) and
+reports points/s with the percentiles of the point time and of the
+controller overhead (point time minus exposure), of the start skew (first
+to last camera started) and of the readout of all cameras, with the frames/s
+read and the bytes copied by the controller (BytesCopied) per frame. --axes
+takes a list of camera counts to compare. With --value-ref the scan is repeated with
+value referencing enabled (frames written to HDF5 by RefOne instead of
+returned by ReadOne) to compare both.
+
+    python benchmarks/bench_controller.py --points 200 --size 1024 --latency 0.001
+    python benchmarks/bench_controller.py --axes 1,2,4,8
+    python benchmarks/bench_controller.py --size 2048 --exposure 0.001
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "controllers"))
+
+import TangoVimbaController as vimba  # noqa: E402
+from fake_vimba import FakeProxyPool, FakeVimbaCamera, report  # noqa: E402
+from sardana.pool.controller import DefaultValue  # noqa: E402
+
+
+class BenchController(vimba.TangoVimbaController):
+    # used by TangoVimbaController, not set by the sardana base class
+    inst_name = "bench"
+
+
+def make_controller(cameras, **props):
+    """A TangoVimbaController on cameras, outside of a Pool."""
+    names = [camera.name for camera in cameras]
+    vimba.discover_devices = lambda *args: names
+    vimba.PROXY_POOL = FakeProxyPool(cameras)
+    values = dict(
+        (name, info.get(DefaultValue))
+        for name, info in vimba.TangoVimbaController.class_prop.items()
+    )
+    values["RootDeviceName"] = "sim/vimba/"
+    values.update(props)
+    ctrl = BenchController("bench", values)
+    for ind in range(1, len(cameras) + 1):
+        ctrl.AddDevice(ind)
+    return ctrl
+
+
+def state(ctrl, axes):
+    ctrl.PreStateAll()
+    for ind in axes:
+        ctrl.PreStateOne(ind)
+    ctrl.StateAll()
+    return [ctrl.StateOne(ind)[0] for ind in axes]
+
+
+def acquire_point(ctrl, axes, integ_time, ref=False):
+    """Acquire one point on axes, return the readout time."""
+    # like the Pool, load the timer (first) axis only
+    ctrl.LoadOne(axes[0], integ_time, 1, 0)
+    ctrl.PreStartAll()
+    for ind in axes:
+        ctrl.StartOne(ind)
+    ctrl.StartAll()
+    while any(sta != vimba.PyTango.DevState.ON for sta in state(ctrl, axes)):
+        # the Pool polls the acquisition state every 10 ms
+        time.sleep(0.01)
+    t = time.time()
+    if ref:
+        ctrl.PreRefAll()
+        for ind in axes:
+            ctrl.PreRefOne(ind)
+        ctrl.RefAll()
+        for ind in axes:
+            ctrl.RefOne(ind)
+    else:
+        ctrl.PreReadAll()
+        for ind in axes:
+            ctrl.PreReadOne(ind)
+        ctrl.ReadAll()
+        for ind in axes:
+            ctrl.ReadOne(ind)
+    return time.time() - t
+
+
+def scan(ctrl, cameras, args, ref=False):
+    """Acquire args.points points, return the samples and the total time."""
+    axes = list(range(1, len(cameras) + 1))
+    ctrl.PrepareOne(axes[0], args.exposure, 1, 0, args.points)
+    samples = {"point": [], "start skew": [], "readout": []}
+    t0 = time.time()
+    for point in range(args.points):
+        t = time.time()
+        readout = acquire_point(ctrl, axes, args.exposure, ref)
+        samples["point"].append(time.time() - t)
+        started = [camera.started_at for camera in cameras]
+        samples["start skew"].append(max(started) - min(started))
+        samples["readout"].append(readout)
+    return samples, time.time() - t0
+
+
+def run(args, nb_axes):
+    cameras = [
+        FakeVimbaCamera(
+            "sim/vimba/%d" % i, args.size, args.size, np.uint16, args.latency
+        )
+        for i in range(nb_axes)
+    ]
+    ctrl = make_controller(cameras)
+    axes = list(range(1, nb_axes + 1))
+    for ind in axes:
+        ctrl.SetExtraAttributePar(ind, "Accumulation", args.accumulation)
+        ctrl.SetExtraAttributePar(ind, "SequenceMode", args.sequence)
+        if args.rois:
+            rois = dict(
+                ("roi%d" % i, [[i, i, i + 64, i + 64]]) for i in range(args.rois)
+            )
+            ctrl.set_rois(ind, rois)
+    samples, elapsed = scan(ctrl, cameras, args)
+    overhead = [p - args.exposure * args.accumulation for p in samples["point"]]
+    calls = sum(camera.calls for camera in cameras)
+
+    print(
+        "%d axes, %dx%d uint16, exposure %.3f s x %d, latency %.1f ms/call"
+        % (
+            nb_axes,
+            args.size,
+            args.size,
+            args.exposure,
+            args.accumulation,
+            args.latency * 1e3,
+        )
+    )
+    report("point", samples["point"], elapsed)
+    report("overhead", overhead, elapsed)
+    report("start skew", samples["start skew"], elapsed)
+    report("readout", samples["readout"], elapsed)
+    frames = nb_axes * args.points * args.accumulation
+    copied = sum(ctrl.GetExtraAttributePar(ind, "BytesCopied") for ind in axes)
+    print(
+        "%.1f frames/s, %.1f MB/s copied, %.2f x the frame size copied per frame"
+        % (
+            frames / elapsed,
+            copied / elapsed / 1e6,
+            copied / float(frames * cameras[0].frame.nbytes),
+        )
+    )
+    print("%.1f device calls/point" % (calls / float(args.points)))
+
+    if args.value_ref:
+        ref_dir = tempfile.mkdtemp()
+        for ind in axes:
+            ctrl.SetAxisPar(ind, "value_ref_enabled", True)
+            ctrl.SetAxisPar(
+                ind,
+                "value_ref_pattern",
+                "h5file://%s/axis%d_{index:06d}.h5" % (ref_dir, ind),
+            )
+        samples, elapsed = scan(ctrl, cameras, args, ref=True)
+        report("point value-ref", samples["point"], elapsed)
+        print("value references written to %s" % ref_dir)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--points", type=int, default=100)
+    parser.add_argument(
+        "--axes",
+        type=lambda value: [int(n) for n in value.split(",")],
+        default=[1],
+        help="number of cameras, or a comma separated list to compare",
+    )
+    parser.add_argument("--size", type=int, default=1024, help="frame width/height")
+    parser.add_argument("--exposure", type=float, default=0.01, help="[s]")
+    parser.add_argument("--latency", type=float, default=0.0005, help="per call [s]")
+    parser.add_argument("--accumulation", type=int, default=1)
+    parser.add_argument("--rois", type=int, default=0)
+    parser.add_argument(
+        "--sequence", action="store_true", help="arm once per scan (SequenceMode)"
+    )
+    parser.add_argument(
+        "--value-ref", action="store_true", help="compare with value referencing"
+    )
+    args = parser.parse_args()
+    for nb_axes in args.axes:
+        run(args, nb_axes)
+
+
+if __name__ == "__main__":
+    main()
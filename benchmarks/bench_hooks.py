@@ -0,0 +1,132 @@
+"""Overhead of the general scan hooks of macros/user.py.
+
+Calls user_pre_scan, user_pre_acq (once per point) and user_post_scan on a
+stand-in macro whose execMacro only sleeps for a configurable time, with
+simulated pressure gauges, and reports calls/s and latency percentiles of
+every hook.
+
+    python benchmarks/bench_hooks.py --scans 5 --points 100 --macro-latency 0.02
+"""
+import argparse
+import inspect
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "macros"))
+
+from sardana.macroserver import basetypes  # noqa: E402
+from sardana.macroserver.macro import Type  # noqa: E402
+
+# parameter types are registered by the MacroServer when it loads macros
+for name, cls in inspect.getmembers(basetypes, inspect.isclass):
+    Type.addType(name)
+
+import health  # noqa: E402
+from acquisition import ACQ_CONF_DEFAULTS  # noqa: E402
+import user  # noqa: E402
+from fake_vimba import FakeAttribute, report  # noqa: E402
+
+
+class FakeGauge(object):
+    def __init__(self, value, latency):
+        self.value = value
+        self.latency = latency
+
+    def set_timeout_millis(self, timeout):
+        pass
+
+    def read_attribute(self, name):
+        time.sleep(self.latency)
+        return FakeAttribute(self.value)
+
+
+class FakeMacro(object):
+    """The Macro API used by the hooks, without a MacroServer."""
+
+    def __init__(self, env, macro_latency):
+        self.env = env
+        self.macro_latency = macro_latency
+        self.executed = []
+
+    def getEnv(self, name):
+        return self.env[name]
+
+    def setEnv(self, name, value):
+        self.env[name] = value
+
+    def execMacro(self, name, *args):
+        self.executed.append(name)
+        time.sleep(self.macro_latency)
+
+    def getParentMacro(self):
+        return None
+
+    def output(self, *args):
+        pass
+
+    debug = info = warning = output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scans", type=int, default=5)
+    parser.add_argument("--points", type=int, default=100)
+    parser.add_argument("--macro-latency", type=float, default=0.01, help="[s]")
+    parser.add_argument("--gauge-latency", type=float, default=0.005, help="[s]")
+    parser.add_argument("--wait-time", type=float, default=0.0, help="[s]")
+    parser.add_argument("--all-checks", action="store_true")
+    args = parser.parse_args()
+
+    for name, device, attribute, limit in health.PRESSURE_GAUGES:
+        health._proxies[device] = FakeGauge(limit / 10, args.gauge_latency)
+    scan_dir = tempfile.mkdtemp()
+    acq_conf = dict((key, args.all_checks) for key in ACQ_CONF_DEFAULTS)
+    acq_conf["waitTime"] = args.wait_time
+    acq_conf["autoShutterPump"] = False
+    env = {
+        "acqConf": acq_conf,
+        "ScanDir": scan_dir,
+        "ScanFile": ["bench.h5"],
+        "ScanID": 0,
+        "ScanHistory": [],
+        "ScanHistoryDB": os.path.join(scan_dir, "history.sqlite"),
+    }
+    macro = FakeMacro(env, args.macro_latency)
+
+    samples = {"user_pre_scan": [], "user_pre_acq": [], "user_post_scan": []}
+    t0 = time.time()
+    for scan in range(args.scans):
+        env["ScanID"] = scan
+        t = time.time()
+        user.user_pre_scan(macro)
+        samples["user_pre_scan"].append(time.time() - t)
+        for point in range(args.points):
+            t = time.time()
+            user.user_pre_acq(macro)
+            samples["user_pre_acq"].append(time.time() - t)
+        t = time.time()
+        user.user_post_scan(macro)
+        samples["user_post_scan"].append(time.time() - t)
+    elapsed = time.time() - t0
+
+    print(
+        "%d scans x %d points, macros %.1f ms, gauges %.1f ms, all checks %s"
+        % (
+            args.scans,
+            args.points,
+            args.macro_latency * 1e3,
+            args.gauge_latency * 1e3,
+            args.all_checks,
+        )
+    )
+    for name, values in samples.items():
+        report(name, values, sum(values), "calls")
+    print("%.1f s total, %d macros run" % (elapsed, len(macro.executed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""sync_data against a full dirsync comparison on a large ScanDir.
+
+Fills a temporary ScanDir with --files small files in --dirs directories and
+times, against a local RemoteScanDir: a full dirsync sync (what sync_data did
+on every call before the manifest), the first sync_data (dirsync plus
+building the manifest), a sync_data with nothing new, the registration by
+user_post_scan of --changed added and as many modified files, the
+sync_data copying them, and sync_data verify.
+
+    python benchmarks/bench_sync.py --files 10000 --changed 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from bench_hooks import FakeMacro  # noqa: E402  (registers the parameter types)
+from dirsync import sync  # noqa: E402
+import scans  # noqa: E402
+
+
+def fill(scan_dir, nb_files, nb_dirs, size):
+    data = os.urandom(size)
+    for i in range(nb_files):
+        directory = os.path.join(scan_dir, "scan_%04d" % (i % nb_dirs))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "file_%06d.dat" % i), "wb") as f:
+            f.write(data)
+
+
+def change(scan_dir, nb_files, size):
+    """Add nb_files files and rewrite as many existing ones, return them."""
+    paths = []
+    directory = os.path.join(scan_dir, "scan_new")
+    os.makedirs(directory, exist_ok=True)
+    for i in range(nb_files):
+        paths.append(os.path.join(directory, "new_%06d.dat" % i))
+        with open(paths[-1], "wb") as f:
+            f.write(os.urandom(size))
+    for i in range(nb_files):
+        path = os.path.join(scan_dir, "scan_0000", "file_%06d.dat" % (i * 1000))
+        if os.path.exists(path):
+            paths.append(path)
+            with open(path, "ab") as f:
+                f.write(b"more")
+    return paths
+
+
+def timed(name, func, *args):
+    t = time.time()
+    func(*args)
+    print("%-24s %8.3f s" % (name, time.time() - t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--size", type=int, default=4096, help="file size [bytes]")
+    parser.add_argument("--changed", type=int, default=10)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    scan_dir = os.path.join(root, "local")
+    remote_dir = os.path.join(root, "remote")
+    os.makedirs(remote_dir)
+    fill(scan_dir, args.files, args.dirs, args.size)
+    env = {
+        "ScanDir": scan_dir,
+        "RemoteScanDir": remote_dir,
+        "ScanHistoryDB": os.path.join(root, "history.sqlite"),
+    }
+    macro = FakeMacro(env, 0.0)
+    print("%d files of %d bytes in %d directories" % (args.files, args.size, args.dirs))
+    try:
+        timed("sync_data first run", scans.sync_data, macro, False)
+        timed("dirsync sync", sync, scan_dir, remote_dir, "sync")
+        timed("sync_data unchanged", scans.sync_data, macro, False)
+        paths = change(scan_dir, args.changed, args.size)
+        timed("register at scan end", scans.manifest_register, macro, scan_dir, paths)
+        name = "sync_data %d+%d changed" % (args.changed, args.changed)
+        timed(name, scans.sync_data, macro, False)
+        timed("sync_data verify", scans.sync_data, macro, True)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""In-process stand-in for TangoVimba devices.
+
+FakeVimbaProxy answers the DeviceProxy calls made by TangoVimbaController
+(commands, attributes and their asynchronous variants) from a simulated
+camera with a configurable frame size, exposure and per-call latency.
+FakeProxyPool serves them in place of the process wide ProxyPool, so the
+controller runs unchanged without a Tango database or camera.
+"""
+import itertools
+import threading
+import time
+
+import numpy as np
+import tango
+
+IMAGE_TYPES = {
+    np.dtype(np.uint8): tango.CmdArgType.DevUChar,
+    np.dtype(np.uint16): tango.CmdArgType.DevUShort,
+    np.dtype(np.int32): tango.CmdArgType.DevLong,
+    np.dtype(np.float32): tango.CmdArgType.DevFloat,
+}
+
+
+def fail(desc):
+    tango.Except.throw_exception("FakeVimba_Error", desc, "FakeVimbaProxy")
+
+
+class FakeTime(object):
+    def __init__(self, stamp):
+        self.stamp = stamp
+
+    def totime(self):
+        return self.stamp
+
+
+class FakeAttribute(object):
+    """DeviceAttribute-like result of read_attribute."""
+
+    def __init__(self, value, type=None, dim_x=0, dim_y=0, stamp=None):
+        self.value = value
+        self.type = type
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.time = FakeTime(time.time() if stamp is None else stamp)
+
+
+class FakeVimbaCamera(object):
+    """Simulated camera: ON, MOVING for exposure s after a start, ON again.
+
+    latency (s) is added to every call to mimic the network and the device
+    server; events makes subscribe_event fail like a device without change
+    events when False. Every call fails while online is False.
+    """
+
+    def __init__(
+        self,
+        name,
+        width=1024,
+        height=1024,
+        dtype=np.uint16,
+        latency=0.0,
+        events=False,
+    ):
+        self.name = name
+        self.latency = latency
+        self.events = events
+        self.exposure = 10000.0  # us
+        self.trigger_source = "Freerun"
+        self.online = True
+        self.busy_until = 0.0
+        self.started_at = 0.0
+        self.frame_time = 0.0
+        self.last_frame_time = 0.0
+        self.frames = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 1000, size=(height, width))
+        self.frame = frame.astype(dtype)
+
+    def state(self):
+        if time.time() < self.busy_until:
+            return tango.DevState.MOVING
+        return tango.DevState.ON
+
+    def start(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.frame_time:
+                self.last_frame_time = self.frame_time
+            self.started_at = now
+            self.busy_until = now + self.exposure * 1e-6
+            self.frame_time = self.busy_until
+            self.frames += 1
+
+    def stop(self):
+        with self.lock:
+            self.busy_until = 0.0
+
+    def image(self, extract_as=None):
+        # the image of an exposure still running is the previous one
+        stamp = self.frame_time
+        if time.time() < stamp:
+            stamp = self.last_frame_time
+        # like PyTango, every extraction is a new copy of the frame
+        value = self.frame.copy()
+        if extract_as == tango.ExtractAs.Bytes:
+            value = self.frame.tobytes()
+        return FakeAttribute(
+            value,
+            IMAGE_TYPES[self.frame.dtype],
+            self.frame.shape[1],
+            self.frame.shape[0],
+            stamp,
+        )
+
+
+class FakeVimbaProxy(object):
+    """The DeviceProxy API used by TangoVimbaController, on a FakeVimbaCamera."""
+
+    COMMANDS = ("StartSingleAcquisition", "StartAcquisition", "TriggerSoftware")
+
+    def __init__(self, camera):
+        self.camera = camera
+        self._replies = {}
+        self._ids = itertools.count(1)
+
+    def _online(self):
+        if not self.camera.online:
+            fail("%s is not reachable" % self.camera.name)
+
+    def _call(self):
+        self._online()
+        self.camera.calls += 1
+        if self.camera.latency:
+            time.sleep(self.camera.latency)
+
+    def name(self):
+        return self.camera.name
+
+    def ping(self):
+        self._call()
+        return int(self.camera.latency * 1e6)
+
+    def _command(self, command):
+        if command == "State":
+            return self.camera.state()
+        if command in self.COMMANDS:
+            self.camera.start()
+        elif command == "StopAcquisition":
+            self.camera.stop()
+        else:
+            fail("unknown command %s" % command)
+
+    def _read(self, name, extract_as=None):
+        if name == "image":
+            return self.camera.image(extract_as)
+        if name == "exposure":
+            return FakeAttribute(self.camera.exposure)
+        if name == "trigger_source":
+            return FakeAttribute(self.camera.trigger_source)
+        fail("unknown attribute %s" % name)
+
+    def command_inout(self, command, *args):
+        self._call()
+        return self._command(command)
+
+    def read_attribute(self, name, extract_as=None):
+        self._call()
+        return self._read(name, extract_as)
+
+    def write_attribute(self, name, value):
+        self._call()
+        if name == "exposure":
+            self.camera.exposure = value
+        elif name == "trigger_source":
+            self.camera.trigger_source = value
+
+    # asynchronous calls are executed when sent; the latency of all the
+    # requests in flight overlaps, like on a real device server
+    def _send(self, result):
+        req = next(self._ids)
+        self.camera.calls += 1
+        self._replies[req] = (time.time(), result)
+        return req
+
+    def _reply(self, req):
+        sent, result = self._replies.pop(req)
+        remaining = sent + self.camera.latency - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return result
+
+    def command_inout_asynch(self, command, *args):
+        self._online()
+        return self._send(self._command(command))
+
+    def command_inout_reply(self, req, timeout=None):
+        return self._reply(req)
+
+    def read_attribute_asynch(self, name):
+        self._online()
+        # read when sent, extracted as asked by the reply
+        return self._send(self._read(name, tango.ExtractAs.Bytes))
+
+    def read_attribute_reply(self, req, timeout=None, extract_as=None):
+        attr = self._reply(req)
+        if extract_as != tango.ExtractAs.Bytes and attr.type is not None:
+            shape = (attr.dim_y, attr.dim_x)
+            dtype = self.camera.frame.dtype
+            attr.value = np.frombuffer(attr.value, dtype=dtype).reshape(shape).copy()
+        return attr
+
+    def subscribe_event(self, attr, event_type, callback, *args):
+        if not self.camera.events:
+            fail("no change events for %s" % attr)
+        return next(self._ids)
+
+    def unsubscribe_event(self, event_id):
+        pass
+
+
+class FakeProxyPool(object):
+    """ProxyPool replacement handing out FakeVimbaProxy objects by name."""
+
+    def __init__(self, cameras):
+        self.proxies = dict(
+            (camera.name, FakeVimbaProxy(camera)) for camera in cameras
+        )
+
+    def get(self, name):
+        for device, proxy in self.proxies.items():
+            if name.endswith(device):
+                return proxy
+        fail("no fake device %s" % name)
+
+    def report_failure(self, name):
+        pass
+
+
+def percentiles(samples):
+    """p50, p90, p99 and max of samples, in ms."""
+    values = np.array(samples) * 1e3
+    return tuple(np.percentile(values, [50, 90, 99])) + (values.max(),)
+
+
+def report(name, samples, elapsed, unit="points"):
+    p50, p90, p99, peak = percentiles(samples)
+    print(
+        "%-16s %8.1f %s/s  p50 %7.2f ms  p90 %7.2f ms  p99 %7.2f ms  max %7.2f ms"
+        % (name, len(samples) / elapsed, unit, p50, p90, p99, peak)
+    )
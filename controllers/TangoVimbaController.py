@@ -1,20 +1,332 @@
 import PyTango
 import time, os
+import functools
+import collections
+import json
+import tempfile
+import threading
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
 
 from sardana import State, DataAccess
-from sardana.pool.controller import TwoDController
+from sardana.pool.controller import TwoDController, CounterTimerController
+from sardana.pool.controller import Referable
 from sardana.pool.controller import Type, Access, Description, DefaultValue
 from sardana.pool import PoolUtil
+from sardana.pool.pooldefs import AcqSynch
 
 ReadOnly = DataAccess.ReadOnly
 ReadWrite = DataAccess.ReadWrite
 
+# numpy dtypes of the Tango image types served by TangoVimba
+NUMPY_DTYPE = {
+    PyTango.CmdArgType.DevUChar: np.uint8,
+    PyTango.CmdArgType.DevUShort: np.uint16,
+    PyTango.CmdArgType.DevShort: np.int16,
+    PyTango.CmdArgType.DevULong: np.uint32,
+    PyTango.CmdArgType.DevLong: np.int32,
+    PyTango.CmdArgType.DevFloat: np.float32,
+    PyTango.CmdArgType.DevDouble: np.float64,
+}
+
+
+def split_tango_host(tango_host):
+    """Return (node, port) of a "node[:port]" tango host string."""
+    node, _, port = tango_host.partition(":")
+    return node, int(port) if port else 10000
+
+
+def full_device_name(tango_host, device):
+    if tango_host is None:
+        return device
+    node, port = split_tango_host(tango_host)
+    return "%s:%d/%s" % (node, port, device)
+
+
+class ProxyPool(object):
+    """Process-wide pool of DeviceProxy objects keyed by full device name.
+
+    Proxies are created lazily on first use and shared by all controllers of
+    the Pool process. A proxy is pinged at most once per health_period; a
+    device that cannot be reached is retried with exponential backoff.
+    Proxies are created and pinged outside the lock, so a slow device does
+    not block the others.
+    """
+
+    def __init__(self, health_period=10.0, backoff_min=1.0, backoff_max=60.0):
+        self.health_period = health_period
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._proxies = {}
+        self._checked = {}
+        self._backoff = {}
+        self._retry_at = {}
+
+    def get(self, name):
+        with self._lock:
+            now = time.time()
+            if now < self._retry_at.get(name, 0):
+                PyTango.Except.throw_exception(
+                    "ProxyPool_Backoff",
+                    "%s unreachable, next retry in %.1f s"
+                    % (name, self._retry_at[name] - now),
+                    "ProxyPool.get",
+                )
+            proxy = self._proxies.get(name)
+            if proxy is not None and now - self._checked[name] <= self.health_period:
+                return proxy
+        try:
+            if proxy is None:
+                proxy = PyTango.DeviceProxy(name)
+            proxy.ping()
+        except PyTango.DevFailed:
+            with self._lock:
+                self._fail(name, time.time())
+            raise
+        with self._lock:
+            # keep the proxy of a thread that connected at the same time
+            proxy = self._proxies.setdefault(name, proxy)
+            self._checked[name] = time.time()
+            self._backoff.pop(name, None)
+            return proxy
+
+    def report_failure(self, name):
+        """Drop the proxy of a device that stopped answering."""
+        with self._lock:
+            self._fail(name, time.time())
+
+    def _fail(self, name, now):
+        self._proxies.pop(name, None)
+        backoff = min(
+            self._backoff.get(name, self.backoff_min / 2.0) * 2, self.backoff_max
+        )
+        self._backoff[name] = backoff
+        self._retry_at[name] = now + backoff
+
+
+PROXY_POOL = ProxyPool()
+
+def bin_frame(frame, factor):
+    """Mean over factor x factor pixel blocks; edge pixels that do not fill a
+    whole block are dropped."""
+    if factor <= 1:
+        return np.array(frame)
+    rows = frame.shape[0] // factor
+    cols = frame.shape[1] // factor
+    blocks = frame[: rows * factor, : cols * factor].reshape(
+        rows, factor, cols, factor
+    )
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+class LivePublisher(object):
+    """ZeroMQ PUB stream of the frames read by the controllers.
+
+    Frames are queued in a ring of ring_size entries and sent by a
+    background thread, so a slow or missing viewer never delays a read; when
+    the ring is full the oldest frame is dropped. Each message has three
+    parts: the topic (device name), a JSON header and the raw pixels.
+    """
+
+    def __init__(self, endpoint, ring_size):
+        self.endpoint = endpoint
+        self.ring = collections.deque(maxlen=ring_size)
+        self.dropped = 0
+        self.sent = 0
+        self._cond = threading.Condition()
+        self._socket = zmq.Context.instance().socket(zmq.PUB)
+        self._socket.setsockopt(zmq.SNDHWM, ring_size)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind(endpoint)
+        thread = threading.Thread(target=self._send, daemon=True)
+        thread.start()
+
+    def publish(self, topic, header, frame):
+        with self._cond:
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append((topic, header, frame))
+            self._cond.notify()
+
+    def _send(self):
+        while True:
+            with self._cond:
+                while not self.ring:
+                    self._cond.wait()
+                topic, header, frame = self.ring.popleft()
+            frame = np.ascontiguousarray(frame)
+            header = dict(header, shape=frame.shape, dtype=str(frame.dtype))
+            try:
+                self._socket.send_multipart(
+                    [topic.encode(), json.dumps(header).encode(), frame],
+                    flags=zmq.NOBLOCK,
+                    copy=False,
+                )
+            except zmq.Again:
+                self.dropped += 1
+            else:
+                self.sent += 1
+
+
+# one publisher per endpoint and Pool process
+LIVE_PUBLISHERS = {}
+_live_lock = threading.Lock()
+
+
+def live_publisher(endpoint, ring_size):
+    if zmq is None:
+        raise RuntimeError("the live view needs pyzmq")
+    with _live_lock:
+        publisher = LIVE_PUBLISHERS.get(endpoint)
+        if publisher is None:
+            publisher = LivePublisher(endpoint, ring_size)
+            LIVE_PUBLISHERS[endpoint] = publisher
+        return publisher
 
-class TangoVimbaController(TwoDController):
+
+class DarkLibrary(object):
+    """Averaged dark frames on disk, keyed by device, exposure and laser mode.
+
+    Every dark is a float32 .npy file, loaded memory-mapped and shared by all
+    axes using it. A dark older than max_age seconds is treated as missing.
+    """
+
+    def __init__(self, directory, max_age):
+        self.directory = directory
+        self.max_age = max_age
+        self._loaded = {}
+
+    def path(self, device, exposure, mode):
+        name = "%s_%dus_%s.npy" % (
+            device.replace("/", "_"),
+            round(exposure * 1e6),
+            mode,
+        )
+        return os.path.join(self.directory, name)
+
+    def age(self, device, exposure, mode):
+        """Age in s of the dark, None if there is none or it is too old."""
+        try:
+            age = time.time() - os.path.getmtime(self.path(device, exposure, mode))
+        except OSError:
+            return None
+        return age if age <= self.max_age else None
+
+    def get(self, device, exposure, mode):
+        path = self.path(device, exposure, mode)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if time.time() - mtime > self.max_age:
+            return None
+        loaded = self._loaded.get(path)
+        if loaded is None or loaded[0] != mtime:
+            loaded = (mtime, np.load(path, mmap_mode="r"))
+            self._loaded[path] = loaded
+        return loaded[1]
+
+    def store(self, device, exposure, mode, mean):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(device, exposure, mode)
+        tmp = path + ".%d.tmp" % os.getpid()
+        with open(tmp, "wb") as f:
+            np.save(f, mean.astype(np.float32))
+        os.replace(tmp, path)
+
+
+# axes of the TangoVimbaControllers by full device name, used by
+# TangoVimbaROICounterController to reach the frames of a camera
+VIMBA_AXES = {}
+
+DISCOVERY_CACHE = os.path.join(
+    tempfile.gettempdir(), "TangoVimbaController_devices.json"
+)
+_discovery_lock = threading.Lock()
+
+
+def _query_devices(tango_host, pattern):
+    if tango_host is None:
+        db = PyTango.Database()
+    else:
+        db = PyTango.Database(*split_tango_host(tango_host))
+    names = list(db.get_device_exported(pattern).value_string)
+    with _discovery_lock:
+        try:
+            with open(DISCOVERY_CACHE) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+        cache["%s|%s" % (tango_host, pattern)] = [time.time(), names]
+        tmp = DISCOVERY_CACHE + ".%d" % os.getpid()
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, DISCOVERY_CACHE)
+    return names
+
+
+def discover_devices(tango_host, pattern, ttl, refresh=False):
+    """Exported devices matching pattern, cached on disk for ttl seconds.
+
+    A stale cache entry is returned immediately and refreshed in a background
+    thread, so that a Pool restart does not wait on a slow database. The
+    database is only queried synchronously when nothing is cached or when
+    refresh is set.
+    """
+    entry = None
+    if not refresh:
+        with _discovery_lock:
+            try:
+                with open(DISCOVERY_CACHE) as f:
+                    entry = json.load(f).get("%s|%s" % (tango_host, pattern))
+            except (IOError, ValueError):
+                pass
+    if entry is None:
+        return _query_devices(tango_host, pattern)
+    stamp, names = entry
+    if time.time() - stamp > ttl:
+        thread = threading.Thread(
+            target=_query_devices, args=(tango_host, pattern), daemon=True
+        )
+        thread.start()
+    return names
+
+
+class TangoVimbaController(TwoDController, Referable):
     "This class is the Tango Sardana Two D controller for the TangoVimba"
 
     ctrl_extra_attributes = {
-        "TangoDevice": {Type: "PyTango.DevString", Access: ReadOnly}
+        "TangoDevice": {Type: "PyTango.DevString", Access: ReadOnly},
+        "BytesCopied": {Type: "PyTango.DevLong", Access: ReadOnly},
+        "StateRoundTripsAvoided": {Type: "PyTango.DevLong", Access: ReadOnly},
+        "StateLatency": {Type: "PyTango.DevDouble", Access: ReadOnly},
+        "SequenceMode": {Type: "PyTango.DevBoolean", Access: ReadWrite},
+        "FramesReceived": {Type: "PyTango.DevLong", Access: ReadOnly},
+        "ROIs": {Type: "PyTango.DevString", Access: ReadWrite},
+        "FrameOutput": {Type: "PyTango.DevBoolean", Access: ReadWrite},
+        "H5Compression": {Type: "PyTango.DevString", Access: ReadWrite},
+        "H5ChunkRows": {Type: "PyTango.DevLong", Access: ReadWrite},
+        "LiveView": {Type: "PyTango.DevBoolean", Access: ReadWrite},
+        "LiveBinning": {Type: "PyTango.DevLong", Access: ReadWrite},
+        "LiveFramesDropped": {Type: "PyTango.DevLong", Access: ReadOnly},
+        "DarkSubtraction": {Type: "PyTango.DevBoolean", Access: ReadWrite},
+        "DarkMode": {Type: "PyTango.DevString", Access: ReadWrite},
+        "DarkRecord": {Type: "PyTango.DevBoolean", Access: ReadWrite},
+        "DarkExposure": {Type: "PyTango.DevDouble", Access: ReadWrite},
+        "DarkAge": {Type: "PyTango.DevDouble", Access: ReadOnly},
+        "Accumulation": {Type: "PyTango.DevLong", Access: ReadWrite},
+        "AccumulationStats": {Type: "PyTango.DevString", Access: ReadOnly},
+        "StatePolls": {Type: "PyTango.DevLong", Access: ReadOnly},
     }
 
     class_prop = {
@@ -26,6 +338,86 @@ class TangoVimbaController(TwoDController):
             Type: str,
             Description: "The tango host where searching the devices",
         },
+        "ImageAttribute": {
+            Type: str,
+            Description: "The image attribute of the TangoVimba devices",
+            DefaultValue: "image",
+        },
+        "StateStaleness": {
+            Type: float,
+            Description: "Maximum age in s of a polled state answered from cache",
+            DefaultValue: 0.1,
+        },
+        "ExposureAttribute": {
+            Type: str,
+            Description: "The exposure time attribute (in us) of the devices",
+            DefaultValue: "exposure",
+        },
+        "TriggerSourceAttribute": {
+            Type: str,
+            Description: "The trigger source attribute of the devices",
+            DefaultValue: "trigger_source",
+        },
+        "HardwareTriggerSource": {
+            Type: str,
+            Description: "Trigger source used for hardware synchronization",
+            DefaultValue: "Line1",
+        },
+        "SoftwareTriggerSource": {
+            Type: str,
+            Description: "Trigger source used for software triggered sequences",
+            DefaultValue: "Software",
+        },
+        "DefaultTriggerSource": {
+            Type: str,
+            Description: "Trigger source restored after a sequence",
+            DefaultValue: "Freerun",
+        },
+        "ArmCommand": {
+            Type: str,
+            Description: "Command arming the camera for a sequence of triggers",
+            DefaultValue: "StartAcquisition",
+        },
+        "SoftwareTriggerCommand": {
+            Type: str,
+            Description: "Command sending a software trigger to an armed camera",
+            DefaultValue: "TriggerSoftware",
+        },
+        "DiscoveryTTL": {
+            Type: float,
+            Description: "Time in s the list of exported devices is cached",
+            DefaultValue: 3600.0,
+        },
+        "LiveViewEndpoint": {
+            Type: str,
+            Description: "ZeroMQ endpoint publishing the frames read",
+            DefaultValue: "tcp://*:5560",
+        },
+        "LiveViewRing": {
+            Type: int,
+            Description: "Number of frames queued for the live view at most",
+            DefaultValue: 4,
+        },
+        "DarkDirectory": {
+            Type: str,
+            Description: "Directory of the dark frame library",
+            DefaultValue: os.path.join(tempfile.gettempdir(), "TangoVimba_darks"),
+        },
+        "DarkMaxAge": {
+            Type: float,
+            Description: "Age in s after which a dark has to be taken again",
+            DefaultValue: 3600.0,
+        },
+        "StateWakeup": {
+            Type: float,
+            Description: "Time in s before the end of an exposure to start polling",
+            DefaultValue: 0.02,
+        },
+        "AcquisitionTimeout": {
+            Type: float,
+            Description: "Time in s after an exposure end to abort it, 0 for never",
+            DefaultValue: 10.0,
+        },
     }
 
     MaxDevice = 97
@@ -33,69 +425,352 @@ class TangoVimbaController(TwoDController):
     def __init__(self, inst, props, *args, **kwargs):
         self.TangoHost = None
         TwoDController.__init__(self, inst, props, *args, **kwargs)
+        self._synchronization = AcqSynch.SoftwareTrigger
         print("PYTHON -> TwoDController ctor for instance", inst)
 
         self.ct_name = "TangoVimbaCtrl/" + self.inst_name
-        if self.TangoHost == None:
-            self.db = PyTango.Database()
-        else:
-            self.node = self.TangoHost
-            self.port = 10000
-            if self.TangoHost.find(":"):
-                lst = self.TangoHost.split(":")
-                self.node = lst[0]
-                self.port = int(lst[1])
-            self.db = PyTango.Database(self.node, self.port)
-        name_dev_ask = self.RootDeviceName + "*"
-        self.devices = self.db.get_device_exported(name_dev_ask)
-        self.max_device = 0
         self.tango_device = []
+        self._discover()
         self.proxy = []
         self.device_available = []
         self.start_time = []
+        self.buffer = []
+        self.bytes_copied = []
+        self.state_cache = []
+        self.event_id = []
+        self.round_trips_avoided = []
+        self.state_latency = []
+        self.exposure_loaded = []
+        self.sequence_mode = []
+        self.armed = []
+        self.hardware_armed = []
+        self.frames_total = []
+        self.frames_target = []
+        self.frames_received = []
+        self.frame_queue = []
+        self.image_event_id = []
+        self.arm_time = []
+        self.last_poll = []
+        self.last_stamp = []
+        self.frame_stamp = []
+        self.roi_names = []
+        self.roi_rects = []
+        self.roi_sums = []
+        self.roi_means = []
+        self.roi_stamp = []
+        self.frame_output = []
+        self.value_ref_enabled = []
+        self.value_ref_pattern = []
+        self.ref_index = []
+        self.h5_compression = []
+        self.h5_chunk_rows = []
+        self.live_view = []
+        self.live_binning = []
+        self.live_index = []
+        self.dark_subtraction = []
+        self.dark_mode = []
+        self.dark_record = []
+        self.dark_exposure = []
+        self.dark_sum = []
+        self.dark_count = []
+        self.corrected = []
+        self.accumulation = []
+        self.acc_count = []
+        self.acc_active = []
+        self.acc_buffer = []
+        self.acc_stats = []
+        self.acquiring = []
+        self.expected_end = []
+        self.state_polls = []
+        self.prepared = []
+        self.start_error = []
         self.exp_time = 0
-        for name in self.devices.value_string:
-            self.tango_device.append(name)
+        self.prepare_count = 0
+        self.prepare_starts = (1, 1)
+        self.read_axes = []
+        self.start_axes = []
+        self.state_axes = []
+        self.state_reply = {}
+        self.read_error = {}
+        for i in range(self.MaxDevice):
             self.proxy.append(None)
             self.device_available.append(0)
             self.start_time.append(time.time())
-            self.max_device = self.max_device + 1
-        self.started = False
+            self.buffer.append(None)
+            self.bytes_copied.append(0)
+            self.state_cache.append(None)
+            self.event_id.append(None)
+            self.round_trips_avoided.append(0)
+            self.state_latency.append(0.0)
+            self.exposure_loaded.append(None)
+            self.sequence_mode.append(False)
+            self.armed.append(False)
+            self.hardware_armed.append(False)
+            self.frames_total.append(0)
+            self.frames_target.append(0)
+            self.frames_received.append(0)
+            self.frame_queue.append(collections.deque())
+            self.image_event_id.append(None)
+            self.arm_time.append(0.0)
+            self.last_poll.append(0.0)
+            self.last_stamp.append(0.0)
+            self.frame_stamp.append(0.0)
+            self.roi_names.append([])
+            self.roi_rects.append(np.zeros((0, 4), dtype=int))
+            self.roi_sums.append(np.zeros(0))
+            self.roi_means.append(np.zeros(0))
+            self.roi_stamp.append(0.0)
+            self.frame_output.append(True)
+            self.value_ref_enabled.append(False)
+            self.value_ref_pattern.append("")
+            self.ref_index.append(0)
+            self.h5_compression.append("")
+            self.h5_chunk_rows.append(0)
+            self.live_view.append(False)
+            self.live_binning.append(1)
+            self.live_index.append(0)
+            self.dark_subtraction.append(False)
+            self.dark_mode.append("dark")
+            self.dark_record.append(False)
+            self.dark_exposure.append(0.0)
+            self.dark_sum.append(None)
+            self.dark_count.append(0)
+            self.corrected.append(None)
+            self.accumulation.append(1)
+            self.acc_count.append(0)
+            self.acc_active.append(False)
+            self.acc_buffer.append(None)
+            self.acc_stats.append([])
+            self.acquiring.append(False)
+            self.expected_end.append(0.0)
+            self.state_polls.append(0)
+            self.prepared.append(0)
+            self.start_error.append(None)
+        self.darks = DarkLibrary(self.DarkDirectory, self.DarkMaxAge)
+        self.placeholder = np.zeros((1, 1), dtype=np.uint16)
+
+    def _discover(self, refresh=False):
+        try:
+            self.tango_device = discover_devices(
+                self.TangoHost, self.RootDeviceName + "*", self.DiscoveryTTL, refresh
+            )
+        except PyTango.DevFailed as e:
+            # keep the controller alive, AddDevice retries the discovery
+            print("Device discovery failed for", self.ct_name, ":", e)
+        self.max_device = len(self.tango_device)
+
+    def _attach(self, ind, rediscover=False):
+        """Get the proxy of axis ind from the process wide pool."""
+        if ind > self.max_device and rediscover:
+            self._discover(refresh=True)
+        if ind > self.max_device:
+            print("False index")
+            return False
+        proxy_name = full_device_name(self.TangoHost, self.tango_device[ind - 1])
+        try:
+            proxy = PROXY_POOL.get(proxy_name)
+        except PyTango.DevFailed as e:
+            # reported once per connection attempt, not at every poll
+            if e.args[0].reason != "ProxyPool_Backoff":
+                print("Could not connect to", proxy_name, ":", e.args[0].desc)
+            return False
+        if proxy is not self.proxy[ind - 1]:
+            if self.event_id[ind - 1] is not None:
+                try:
+                    self.proxy[ind - 1].unsubscribe_event(self.event_id[ind - 1])
+                except PyTango.DevFailed:
+                    pass
+            self.proxy[ind - 1] = proxy
+            self._subscribe_state(ind)
+        self.device_available[ind - 1] = 1
+        VIMBA_AXES[proxy_name] = (self, ind)
+        return True
+
+    def _detach(self, ind):
+        """Mark axis ind unreachable; StateOne reattaches with backoff."""
+        self.device_available[ind - 1] = 0
+        self.state_cache[ind - 1] = None
+        PROXY_POOL.report_failure(
+            full_device_name(self.TangoHost, self.tango_device[ind - 1])
+        )
 
     def AddDevice(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In AddDevice method for index",ind
         TwoDController.AddDevice(self, ind)
-        if ind > self.max_device:
-            print("False index")
-            return
-        proxy_name = self.tango_device[ind - 1]
-        if self.TangoHost == None:
-            proxy_name = self.tango_device[ind - 1]
-        else:
-            proxy_name = (
-                str(self.node) + (":%s/" % self.port) + str(self.tango_device[ind - 1])
+        if self._attach(ind, rediscover=True):
+            print(self.proxy[ind - 1].name())
+
+    def _subscribe_state(self, ind):
+        """Track the device state with change events, if the device pushes them.
+
+        Without events StateOne falls back to polling the device at most once
+        per StateStaleness.
+        """
+        self.state_cache[ind - 1] = None
+        try:
+            self.event_id[ind - 1] = self.proxy[ind - 1].subscribe_event(
+                "State",
+                PyTango.EventType.CHANGE_EVENT,
+                functools.partial(self._state_event, ind),
             )
-        self.proxy[ind - 1] = PyTango.DeviceProxy(proxy_name)
-        self.device_available[ind - 1] = 1
-        print(proxy_name)
+        except PyTango.DevFailed:
+            self.event_id[ind - 1] = None
+            print("No state events for", self.tango_device[ind - 1], "- polling")
+
+    def _state_event(self, ind, event):
+        if event.err:
+            # heartbeat lost or device down: drop the cache and poll instead
+            self.state_cache[ind - 1] = None
+        else:
+            self.state_cache[ind - 1] = (event.attr_value.value, time.time(), True)
+
+    def _acquisition_started(self, ind, exposure):
+        """Expect the exposure started now on axis ind to end after exposure s."""
+        self.acquiring[ind - 1] = True
+        self.expected_end[ind - 1] = time.time() + (exposure or 0.0)
+
+    def _cached_state(self, ind):
+        """State of axis ind from the local cache, or None if it is stale.
+
+        During an exposure the axis is MOVING without asking the device until
+        StateWakeup before its expected end; from then on a polled MOVING is
+        reused for half the remaining time only, so the polls get denser
+        towards the end and the end is seen without delay. Otherwise states
+        pushed by events stay valid until the next event and polled states
+        are reused for StateStaleness seconds.
+        """
+        now = time.time()
+        staleness = self.StateStaleness
+        if self.acquiring[ind - 1]:
+            remaining = self.expected_end[ind - 1] - now
+            if remaining > self.StateWakeup:
+                self.round_trips_avoided[ind - 1] += 1
+                self.state_latency[ind - 1] = 0.0
+                return PyTango.DevState.MOVING
+            staleness = min(staleness, max(remaining, 0.0) / 2)
+        cached = self.state_cache[ind - 1]
+        if cached is not None:
+            sta, stamp, from_event = cached
+            age = now - stamp
+            if from_event or age < staleness:
+                self.round_trips_avoided[ind - 1] += 1
+                self.state_latency[ind - 1] = age
+                return sta
+        return None
+
+    def _store_polled_state(self, ind, sta, t0):
+        t1 = time.time()
+        self.state_polls[ind - 1] += 1
+        self.state_latency[ind - 1] = t1 - t0
+        cached = self.state_cache[ind - 1]
+        if cached is None or not cached[2]:
+            # do not overwrite an event that arrived during the round trip
+            self.state_cache[ind - 1] = (sta, t1, False)
+
+    def _device_state(self, ind):
+        sta = self.state_reply.pop(ind, None)
+        if sta is None:
+            sta = self._cached_state(ind)
+        if sta is None:
+            t0 = time.time()
+            sta = self.proxy[ind - 1].command_inout("State")
+            self._store_polled_state(ind, sta, t0)
+        return sta
 
     def DeleteDevice(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In DeleteDevice method for index",ind
         TwoDController.DeleteDevice(self, ind)
+        if ind <= self.max_device:
+            VIMBA_AXES.pop(
+                full_device_name(self.TangoHost, self.tango_device[ind - 1]), None
+            )
+        if self.armed[ind - 1]:
+            self._disarm(ind)
+        if self.event_id[ind - 1] is not None:
+            try:
+                self.proxy[ind - 1].unsubscribe_event(self.event_id[ind - 1])
+            except PyTango.DevFailed:
+                pass
+            self.event_id[ind - 1] = None
+        self.state_cache[ind - 1] = None
         self.proxy[ind - 1] = None
         self.device_available[ind - 1] = 0
+        self.buffer[ind - 1] = None
+
+    def PreStateAll(self):
+        self.state_axes = []
+        self.state_reply = {}
+
+    def PreStateOne(self, ind):
+        if self.device_available[ind - 1] == 1:
+            self.state_axes.append(ind)
+
+    def StateAll(self):
+        """Poll all axes without a valid cached state concurrently."""
+        t0 = time.time()
+        requests = []
+        for ind in self.state_axes:
+            sta = self._cached_state(ind)
+            if sta is not None:
+                self.state_reply[ind] = sta
+                continue
+            try:
+                req = self.proxy[ind - 1].command_inout_asynch("State")
+            except PyTango.DevFailed:
+                # StateOne retries this axis synchronously
+                continue
+            requests.append((ind, req))
+        for ind, req in requests:
+            try:
+                sta = self.proxy[ind - 1].command_inout_reply(req, 0)
+            except PyTango.DevFailed:
+                # StateOne retries this axis synchronously
+                continue
+            self._store_polled_state(ind, sta, t0)
+            self.state_reply[ind] = sta
 
     def StateOne(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In StateOne method for index",ind
+        if self.device_available[ind - 1] != 1 and not self._attach(ind):
+            return (PyTango.DevState.FAULT, "Camera not connected")
+        if self.start_error[ind - 1] is not None:
+            desc = self.start_error[ind - 1]
+            self.start_error[ind - 1] = None
+            return (PyTango.DevState.FAULT, "Camera not started: " + desc)
         if self.device_available[ind - 1] == 1:
-            #            if time.time() - self.start_time[ind-1] > self.exp_time and self.started == True:
-            #                try:
-            #                    self.proxy[ind-1].command_inout("StopAcquisition")
-            #                    self.started = False
-            #                except:
-            #                    pass
-            sta = self.proxy[ind - 1].command_inout("State")
-            print(sta)
+            try:
+                sta = self._device_state(ind)
+            except PyTango.DevFailed as e:
+                self._detach(ind)
+                return (PyTango.DevState.FAULT, e.args[0].desc)
+            if self.acquiring[ind - 1]:
+                overdue = time.time() - self.expected_end[ind - 1]
+                if sta not in (PyTango.DevState.MOVING, PyTango.DevState.EXTRACT):
+                    self.acquiring[ind - 1] = False
+                elif self.AcquisitionTimeout > 0 and overdue > self.AcquisitionTimeout:
+                    # watchdog: the camera never finished the exposure
+                    self.acquiring[ind - 1] = False
+                    self.AbortOne(ind)
+                    self.state_cache[ind - 1] = None
+                    return (
+                        PyTango.DevState.FAULT,
+                        "Acquisition aborted, not finished %.1f s after the exposure"
+                        % overdue,
+                    )
+            if self.armed[ind - 1] and sta not in (
+                PyTango.DevState.FAULT,
+                PyTango.DevState.ALARM,
+            ):
+                return self._sequence_state(ind)
+            if self._accumulating(ind):
+                if sta == PyTango.DevState.ON:
+                    self._accumulate(ind)
+                if self._accumulating(ind):
+                    return (
+                        PyTango.DevState.MOVING,
+                        "Camera accumulating frame %d of %d"
+                        % (self.acc_count[ind - 1] + 1, self.accumulation[ind - 1]),
+                    )
             if sta == PyTango.DevState.ON:
                 tup = (sta, "Camera ready")
             elif (sta == PyTango.DevState.MOVING) or (sta == PyTango.DevState.EXTRACT):
@@ -106,11 +781,333 @@ class TangoVimbaController(TwoDController):
             elif sta == PyTango.DevState.ALARM:
                 sta = PyTango.DevState.FAULT
                 tup = (sta, "Device in ALARM state")
+            else:
+                tup = (sta, "Camera in %s state" % sta)
             return tup
 
+    def _sequence_state(self, ind):
+        if self.image_event_id[ind - 1] is None:
+            self._poll_sequence_frame(ind)
+        if self.frames_received[ind - 1] < self.frames_target[ind - 1]:
+            return (PyTango.DevState.MOVING, "Camera waiting for triggers")
+        if self.frames_received[ind - 1] >= self.frames_total[ind - 1]:
+            self._disarm(ind)
+        return (PyTango.DevState.ON, "Camera ready")
+
+    def _load_exposure(self, ind, value):
+        """Write the exposure time to the camera, only if it changed."""
+        self.exp_time = value
+        if self.exposure_loaded[ind - 1] != value:
+            self.proxy[ind - 1].write_attribute(self.ExposureAttribute, value * 1e6)
+            self.exposure_loaded[ind - 1] = value
+
+    def _arm(self, ind, hardware, nb_frames):
+        """Arm the camera once for a sequence of nb_frames triggered frames.
+
+        Frames are collected from image change events as they arrive or, if
+        the device does not push them, by polling the image attribute and
+        comparing its timestamp with the last frame seen.
+        """
+        if self.armed[ind - 1]:
+            self._disarm(ind)
+        proxy = self.proxy[ind - 1]
+        if hardware:
+            source = self.HardwareTriggerSource
+        else:
+            source = self.SoftwareTriggerSource
+        proxy.write_attribute(self.TriggerSourceAttribute, source)
+        self.frame_queue[ind - 1].clear()
+        self.frames_received[ind - 1] = 0
+        self.frames_total[ind - 1] = nb_frames
+        self.frames_target[ind - 1] = nb_frames if hardware else 0
+        self.hardware_armed[ind - 1] = hardware
+        self.arm_time[ind - 1] = time.time()
+        try:
+            self.image_event_id[ind - 1] = proxy.subscribe_event(
+                self.ImageAttribute,
+                PyTango.EventType.CHANGE_EVENT,
+                functools.partial(self._image_event, ind),
+            )
+        except PyTango.DevFailed:
+            self.image_event_id[ind - 1] = None
+            self.last_poll[ind - 1] = 0.0
+            self.last_stamp[ind - 1] = 0.0
+        self.armed[ind - 1] = True
+        proxy.command_inout(self.ArmCommand)
+
+    def _disarm(self, ind):
+        self.armed[ind - 1] = False
+        proxy = self.proxy[ind - 1]
+        try:
+            proxy.command_inout("StopAcquisition")
+        except PyTango.DevFailed:
+            pass
+        if self.image_event_id[ind - 1] is not None:
+            try:
+                proxy.unsubscribe_event(self.image_event_id[ind - 1])
+            except PyTango.DevFailed:
+                pass
+            self.image_event_id[ind - 1] = None
+        try:
+            proxy.write_attribute(
+                self.TriggerSourceAttribute, self.DefaultTriggerSource
+            )
+        except PyTango.DevFailed:
+            pass
+
+    def _queue_frame(self, ind, frame, stamp):
+        # the first event after subscribing carries the last, pre-arm image
+        if not self.armed[ind - 1] or stamp < self.arm_time[ind - 1]:
+            return
+        self.frame_queue[ind - 1].append((frame, stamp))
+        self.frames_received[ind - 1] += 1
+
+    def _image_event(self, ind, event):
+        if event.err or event.attr_value is None:
+            return
+        value = event.attr_value
+        self._queue_frame(ind, value.value, value.time.totime())
+
+    def _poll_sequence_frame(self, ind):
+        """Poll the image of an armed axis without image events.
+
+        A software triggered frame cannot arrive before the end of its
+        exposure: the image is not read until StateWakeup before it, and then
+        polled at half the remaining time, like the state in _cached_state.
+        Hardware triggered frames come at unknown times and are polled every
+        StateStaleness.
+        """
+        now = time.time()
+        interval = self.StateStaleness
+        if not self.hardware_armed[ind - 1]:
+            remaining = self.expected_end[ind - 1] - now
+            if remaining > self.StateWakeup:
+                return
+            interval = min(interval, max(remaining, 0.0) / 2)
+        if now - self.last_poll[ind - 1] < interval:
+            return
+        self.last_poll[ind - 1] = now
+        attr = self.proxy[ind - 1].read_attribute(self.ImageAttribute)
+        stamp = attr.time.totime()
+        if stamp > self.last_stamp[ind - 1]:
+            self.last_stamp[ind - 1] = stamp
+            self._queue_frame(ind, attr.value, stamp)
+
+    def _store_frame(self, ind, attr):
+        """Keep a frame read with ExtractAs.Numpy as the buffer of axis ind.
+
+        PyTango extracts the image from the reply into a new array, the only
+        copy of the frame made in the controller; it is used as is.
+        """
+        buf = attr.value
+        self.buffer[ind - 1] = buf
+        self.bytes_copied[ind - 1] += buf.nbytes
+        return self._frame_done(ind, buf, attr.time.totime())
+
+    def _frame_done(self, ind, buf, stamp, scale=1):
+        """Dark correct, reduce and publish the new frame buf of axis ind.
+
+        stamp is the time of the frame given by the camera (the end of its
+        exposure), which tells whether it belongs to the last start.
+        """
+        self.frame_stamp[ind - 1] = stamp
+        out = self._dark_correct(ind, buf, self.corrected[ind - 1], scale)
+        self.corrected[ind - 1] = out if out is not buf else None
+        self._reduce_rois(ind, out)
+        self._publish(ind, out)
+        return out
+
+    def _accumulating(self, ind):
+        """Whether axis ind is in an accumulation started by StartAll."""
+        return (
+            self.acc_active[ind - 1]
+            and not self.armed[ind - 1]
+            and self.acc_count[ind - 1] < self.accumulation[ind - 1]
+        )
+
+    def _accumulate(self, ind):
+        """Add the frame just taken by axis ind to its accumulation buffer.
+
+        The sum is kept in place in a wider dtype (uint32 for 8 and 16 bit
+        cameras), so N short exposures do not saturate.
+        """
+        attr = self.proxy[ind - 1].read_attribute(
+            self.ImageAttribute, extract_as=PyTango.ExtractAs.Bytes
+        )
+        dtype = NUMPY_DTYPE[attr.type]
+        frame = np.frombuffer(attr.value, dtype=dtype).reshape(attr.dim_y, attr.dim_x)
+        self.bytes_copied[ind - 1] += frame.nbytes
+        if np.issubdtype(dtype, np.floating):
+            acc_dtype = np.float64
+        elif frame.itemsize > 2:
+            acc_dtype = np.int64
+        elif np.issubdtype(dtype, np.unsignedinteger):
+            acc_dtype = np.uint32
+        else:
+            acc_dtype = np.int32
+        acc = self.acc_buffer[ind - 1]
+        if self.acc_count[ind - 1] == 0:
+            if acc is None or acc.shape != frame.shape or acc.dtype != acc_dtype:
+                acc = self.acc_buffer[ind - 1] = np.empty(frame.shape, acc_dtype)
+            acc.fill(0)
+            self.acc_stats[ind - 1] = []
+        np.add(acc, frame, out=acc, casting="unsafe")
+        self.acc_count[ind - 1] += 1
+        self.acc_stats[ind - 1].append((float(frame.mean()), float(frame.max())))
+        if self.acc_count[ind - 1] == self.accumulation[ind - 1]:
+            self.acc_active[ind - 1] = False
+            self.buffer[ind - 1] = acc
+            self._frame_done(ind, acc, attr.time.totime(), self.acc_count[ind - 1])
+        else:
+            self.state_cache[ind - 1] = None
+            self.proxy[ind - 1].command_inout("StartSingleAcquisition")
+            self._acquisition_started(ind, self.exposure_loaded[ind - 1])
+
+    def _dark(self, ind, frame):
+        exposure = self.exposure_loaded[ind - 1]
+        if exposure is None:
+            return None
+        dark = self.darks.get(
+            self.tango_device[ind - 1], exposure, self.dark_mode[ind - 1]
+        )
+        if dark is None or dark.shape != frame.shape:
+            return None
+        return dark
+
+    def _dark_correct(self, ind, frame, out=None, scale=1):
+        """frame minus the matching dark, or frame itself without a dark.
+
+        While DarkRecord is set the frame is added to the dark being recorded
+        instead. out is reused for the result when its shape matches. scale
+        is the number of exposures summed in frame.
+        """
+        if self.dark_record[ind - 1]:
+            acc = self.dark_sum[ind - 1]
+            if acc is None or acc.shape != frame.shape:
+                acc = self.dark_sum[ind - 1] = np.zeros(frame.shape)
+                self.dark_count[ind - 1] = 0
+            acc += frame
+            self.dark_count[ind - 1] += scale
+            return frame
+        if not self.dark_subtraction[ind - 1]:
+            return frame
+        dark = self._dark(ind, frame)
+        if dark is None:
+            return frame
+        if out is None or out.shape != frame.shape:
+            out = np.empty(frame.shape, dtype=np.float32)
+        if scale == 1:
+            np.subtract(frame, dark, out=out, dtype=np.float32)
+        else:
+            np.multiply(dark, -scale, out=out)
+            np.add(out, frame, out=out, casting="unsafe")
+        return out
+
+    def _store_dark(self, ind):
+        """Average the frames recorded with DarkRecord into the library."""
+        if self.dark_count[ind - 1]:
+            self.darks.store(
+                self.tango_device[ind - 1],
+                self.exposure_loaded[ind - 1],
+                self.dark_mode[ind - 1],
+                self.dark_sum[ind - 1] / self.dark_count[ind - 1],
+            )
+        self.dark_sum[ind - 1] = None
+        self.dark_count[ind - 1] = 0
+
+    def _publish(self, ind, frame):
+        """Queue frame for the live view, binned by LiveBinning.
+
+        The frame is the one read for the scan, so viewers need no transfer
+        of their own.
+        """
+        if not self.live_view[ind - 1]:
+            return
+        binning = self.live_binning[ind - 1]
+        self.live_index[ind - 1] += 1
+        header = {
+            "device": self.tango_device[ind - 1],
+            "index": self.live_index[ind - 1],
+            "binning": binning,
+            "time": self.frame_stamp[ind - 1],
+        }
+        publisher = live_publisher(self.LiveViewEndpoint, self.LiveViewRing)
+        publisher.publish(
+            self.tango_device[ind - 1], header, bin_frame(frame, binning)
+        )
+
+    def set_rois(self, ind, rois):
+        """Set the ROIs of axis ind from a DetectorROIs-like dict.
+
+        rois maps ROI names to a list of [x0, y0, x1, y1] rectangles (as
+        stored by LaVue); the first rectangle of every ROI is used. Bounds
+        are in pixels with x along the columns, upper bounds exclusive.
+        """
+        names = sorted(rois)
+        rects = np.array([rois[name][0] for name in names], dtype=int)
+        self.roi_names[ind - 1] = names
+        self.roi_rects[ind - 1] = rects.reshape(-1, 4)
+        self.roi_sums[ind - 1] = np.zeros(len(names))
+        self.roi_means[ind - 1] = np.zeros(len(names))
+        self.roi_stamp[ind - 1] = 0.0
+
+    def _reduce_rois(self, ind, frame):
+        rects = self.roi_rects[ind - 1]
+        if not len(rects):
+            return
+        # summed-area table: every ROI sum is four lookups, whatever its size
+        sat = np.zeros((frame.shape[0] + 1, frame.shape[1] + 1))
+        np.cumsum(frame, axis=0, dtype=np.float64, out=sat[1:, 1:])
+        np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+        x0 = np.clip(rects[:, 0], 0, frame.shape[1])
+        y0 = np.clip(rects[:, 1], 0, frame.shape[0])
+        x1 = np.clip(rects[:, 2], 0, frame.shape[1])
+        y1 = np.clip(rects[:, 3], 0, frame.shape[0])
+        sums = sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+        area = np.maximum((x1 - x0) * (y1 - y0), 1)
+        self.roi_sums[ind - 1] = sums
+        self.roi_means[ind - 1] = sums / area
+        self.roi_stamp[ind - 1] = self.frame_stamp[ind - 1]
+
+    def frame_pending(self, ind):
+        """Whether the frame of the last start of axis ind is not taken yet.
+
+        True until StateOne has seen the camera back in ON after the exposure
+        (and after all the exposures of an accumulation or, when armed, until
+        the frame of the start has arrived).
+        """
+        if self.armed[ind - 1]:
+            return self.frames_received[ind - 1] < self.frames_target[ind - 1]
+        return self.acquiring[ind - 1] or self._accumulating(ind)
+
+    def _fresh(self, ind):
+        """Whether the last frame read on axis ind was taken after its start."""
+        return self.frame_stamp[ind - 1] >= self.start_time[ind - 1]
+
+    def reduce_frame(self, ind):
+        """Make sure the ROIs of axis ind hold the frame of the last start.
+
+        Called by TangoVimbaROICounterController, which may be read before
+        this controller; the frame read here is reused by ReadAll. While the
+        frame is pending nothing is read, the ROIs keep their last values.
+        """
+        if self.roi_stamp[ind - 1] >= self.start_time[ind - 1]:
+            return
+        if self._fresh(ind):
+            self._reduce_rois(ind, self._frame(ind))
+        elif not self.frame_pending(ind):
+            self._read_frame(ind)
+
+    def _read_frame(self, ind):
+        attr = self.proxy[ind - 1].read_attribute(
+            self.ImageAttribute, extract_as=PyTango.ExtractAs.Numpy
+        )
+        return self._store_frame(ind, attr)
+
     def PreReadAll(self):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In PreReadAll method"
-        pass
+        self.read_axes = []
+        self.read_error = {}
 
     def PreReadOne(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In PreReadOne method for index",ind
@@ -118,56 +1115,400 @@ class TangoVimbaController(TwoDController):
         #            self.proxy[ind-1].command_inout("StopAcquisition")
         #        except:
         #            pass
-        pass
+        if self.device_available[ind - 1] == 1:
+            self.read_axes.append(ind)
 
     def ReadAll(self):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In ReadAll method"
-        pass
+        # send all read requests first so the transfers of the cameras overlap;
+        # a failing camera is reported by its own ReadOne, not by ReadAll
+        requests = []
+        for ind in self.read_axes:
+            if self.armed[ind - 1]:
+                continue
+            # the image of a running exposure is the previous frame
+            if self._fresh(ind) or self.frame_pending(ind):
+                continue
+            try:
+                req = self.proxy[ind - 1].read_attribute_asynch(self.ImageAttribute)
+            except PyTango.DevFailed as e:
+                self.read_error[ind] = e
+                continue
+            requests.append((ind, req))
+        for ind, req in requests:
+            try:
+                attr = self.proxy[ind - 1].read_attribute_reply(
+                    req, 0, extract_as=PyTango.ExtractAs.Numpy
+                )
+            except PyTango.DevFailed as e:
+                self.read_error[ind] = e
+                continue
+            self._store_frame(ind, attr)
+
+    def _frame(self, ind):
+        """The last frame of axis ind, dark subtracted if enabled."""
+        if self.corrected[ind - 1] is not None:
+            return self.corrected[ind - 1]
+        return self.buffer[ind - 1]
+
+    def _frames(self, ind):
+        """Frames of axis ind for this read: a list or a single frame."""
+        if self.armed[ind - 1] or self.frame_queue[ind - 1]:
+            return self._read_sequence(ind)
+        if self.buffer[ind - 1] is None:
+            self._read_frame(ind)
+        return self._frame(ind)
 
     def ReadOne(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In ReadOne method for index",ind
-        tmp_value = [(-1,), (-1,)]
         if self.device_available[ind - 1] == 1:
-            return tmp_value
+            if ind in self.read_error:
+                raise self.read_error[ind]
+            frames = self._frames(ind)
+            if self.frame_output[ind - 1]:
+                return frames
+            if isinstance(frames, list):
+                return [self.placeholder] * len(frames)
+            return self.placeholder
+
+    def PreRefAll(self):
+        self.PreReadAll()
+
+    def PreRefOne(self, ind):
+        self.PreReadOne(ind)
+
+    def RefAll(self):
+        self.ReadAll()
+
+    def RefOne(self, ind):
+        """Write the frames of axis ind to HDF5 and return their references.
+
+        Used instead of ReadOne when value referencing is enabled, so that
+        frames are not pushed through the MacroServer and the recorders.
+        """
+        if self.device_available[ind - 1] == 1:
+            if ind in self.read_error:
+                raise self.read_error[ind]
+            frames = self._frames(ind)
+            if isinstance(frames, list):
+                return [self._write_ref(ind, frame) for frame in frames]
+            return self._write_ref(ind, frames)
+
+    def _write_ref(self, ind, frame):
+        """Write one frame as given by the value_ref_pattern of axis ind.
+
+        The pattern is h5file://<path>[::<dataset>] where {index} is replaced
+        by the frame index of the scan. Without {index} all frames go to the
+        same file as numbered datasets.
+        """
+        if h5py is None:
+            raise RuntimeError("value referencing needs h5py")
+        pattern = self.value_ref_pattern[ind - 1]
+        index = self.ref_index[ind - 1]
+        self.ref_index[ind - 1] += 1
+        scheme, _, location = pattern.format(index=index).partition("://")
+        if scheme != "h5file":
+            raise ValueError("only h5file:// value references are supported")
+        path, _, dataset = location.partition("::")
+        dataset = dataset or "/data"
+        if "{index" not in pattern:
+            dataset = "%s_%06d" % (dataset, index)
+        compression = self.h5_compression[ind - 1] or None
+        compression_opts = None
+        if compression is not None and ":" in compression:
+            compression, level = compression.split(":")
+            compression_opts = int(level)
+        rows = self.h5_chunk_rows[ind - 1]
+        chunks = (min(rows, frame.shape[0]), frame.shape[1]) if rows > 0 else None
+        if compression is not None and chunks is None:
+            chunks = frame.shape
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with h5py.File(path, "a") as f:
+            if dataset in f:
+                del f[dataset]
+            f.create_dataset(
+                dataset,
+                data=frame,
+                chunks=chunks,
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+        return "h5file://%s::%s" % (path, dataset)
+
+    def _read_sequence(self, ind):
+        """Return the frames received since the last read.
+
+        With hardware synchronization this is a list with one frame per
+        trigger (possibly empty); with software triggers it is the frame of
+        the current start.
+        """
+        queue = self.frame_queue[ind - 1]
+        frames = []
+        while queue:
+            frame, stamp = queue.popleft()
+            self.bytes_copied[ind - 1] += frame.nbytes
+            frames.append(self._dark_correct(ind, frame))
+        if frames:
+            self.frame_stamp[ind - 1] = stamp
+            self._reduce_rois(ind, frames[-1])
+        for frame in frames:
+            self._publish(ind, frame)
+        if self.hardware_armed[ind - 1]:
+            return frames
+        if frames:
+            self.buffer[ind - 1] = frames[-1]
+            self.corrected[ind - 1] = None
+        return self.buffer[ind - 1]
 
     def PreStartAll(self):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In PreStartAll method"
-        pass
+        self.start_axes = []
 
     def StartOne(self, ind, position=None):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In StartOne method for index",ind
         # self.proxy[ind-1].FileSaving = False
-        self.proxy[ind - 1].command_inout("StartSingleAcquisition")
-        self.started = True
-        self.start_time[ind - 1] = time.time()
+        # the Pool prepares and loads the timer axis only: bring the other
+        # axes to the same exposure and arming before their first start
+        self.state_cache[ind - 1] = None
+        self.start_error[ind - 1] = None
+        try:
+            if self.prepared[ind - 1] != self.prepare_count:
+                self._prepare_axis(ind)
+            if self.exp_time:
+                self._load_exposure(ind, self.exp_time)
+        except PyTango.DevFailed as e:
+            self._start_failed(ind, e)
+            return
+        # the acquisition itself is started for all axes at once in StartAll
+        self.start_axes.append(ind)
+
+    def StartAll(self):
+        """Start all axes with asynchronous commands to minimize start skew.
+
+        Replies are awaited (timeout 0 blocks until they arrive) only after
+        every command has been sent. A camera that fails to start does not
+        stop the others; its StateOne reports the error.
+        """
+        requests = []
+        for ind in self.start_axes:
+            if self.armed[ind - 1]:
+                if self.hardware_armed[ind - 1]:
+                    # armed in PrepareOne, frames come with the triggers
+                    self.start_time[ind - 1] = time.time()
+                    continue
+                command = self.SoftwareTriggerCommand
+            else:
+                command = "StartSingleAcquisition"
+            try:
+                req = self.proxy[ind - 1].command_inout_asynch(command)
+            except PyTango.DevFailed as e:
+                self._start_failed(ind, e)
+                continue
+            self.start_time[ind - 1] = time.time()
+            if self.armed[ind - 1]:
+                self.frames_target[ind - 1] += 1
+                self.expected_end[ind - 1] = self.start_time[ind - 1] + (
+                    self.exposure_loaded[ind - 1] or 0.0
+                )
+            else:
+                self.acc_count[ind - 1] = 0
+                self.acc_active[ind - 1] = self.accumulation[ind - 1] > 1
+                self._acquisition_started(ind, self.exposure_loaded[ind - 1])
+            requests.append((ind, req))
+        for ind, req in requests:
+            try:
+                self.proxy[ind - 1].command_inout_reply(req, 0)
+            except PyTango.DevFailed as e:
+                self._start_failed(ind, e)
+
+    def _start_failed(self, ind, error):
+        self.start_error[ind - 1] = error.args[0].desc
+        self.acquiring[ind - 1] = False
+        self.acc_active[ind - 1] = False
 
     def AbortOne(self, ind):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In AbortOne method for index",ind
+        self.acquiring[ind - 1] = False
+        self.acc_active[ind - 1] = False
+        if self.armed[ind - 1]:
+            self._disarm(ind)
+            return
         try:
             self.proxy[ind - 1].command_inout("StopAcquisition")
         except:
             pass
 
-    def LoadOne(self, ind, value):
+    def SetCtrlPar(self, par, value):
+        if par == "synchronization":
+            self._synchronization = value
+        else:
+            TwoDController.SetCtrlPar(self, par, value)
+
+    def PrepareOne(self, ind, value, repetitions, latency, nb_starts):
+        """Configure the exposure once per scan and arm sequence acquisitions.
+
+        The Pool calls this for the timer axis only; the other axes get the
+        same preparation at their first StartOne of the scan.
+        """
         self.exp_time = value
+        self.prepare_starts = (repetitions, nb_starts)
+        self.prepare_count += 1
+        self._prepare_axis(ind)
+
+    def _prepare_axis(self, ind):
+        """Apply the preparation of the current scan to axis ind.
+
+        The camera is armed here, once per scan, when it is hardware
+        synchronized, or when SequenceMode is set and the scan has more than
+        one software start. Otherwise every start is a single acquisition.
+        """
+        self.prepared[ind - 1] = self.prepare_count
+        repetitions, nb_starts = self.prepare_starts
+        self._load_exposure(ind, self.exp_time)
+        self.ref_index[ind - 1] = 0
+        hardware = self._synchronization in (
+            AcqSynch.HardwareTrigger,
+            AcqSynch.HardwareGate,
+            AcqSynch.HardwareStart,
+        )
+        if hardware:
+            self._arm(ind, True, repetitions * nb_starts)
+        elif self.sequence_mode[ind - 1] and nb_starts > 1:
+            self._arm(ind, False, nb_starts)
+        elif self.armed[ind - 1]:
+            self._disarm(ind)
+
+    def LoadOne(self, ind, value, repetitions, latency):
+        self._load_exposure(ind, value)
 
     def GetAxisPar(self, ind, par_name):
         if par_name == "data_source":
             data_source = "Not set"
             return data_source
+        elif par_name == "value_ref_enabled":
+            return self.value_ref_enabled[ind - 1]
+        elif par_name == "value_ref_pattern":
+            return self.value_ref_pattern[ind - 1]
+
+    def SetAxisPar(self, ind, par_name, value):
+        if par_name == "value_ref_enabled":
+            if value and h5py is None:
+                raise RuntimeError("value referencing needs h5py")
+            self.value_ref_enabled[ind - 1] = value
+        elif par_name == "value_ref_pattern":
+            self.value_ref_pattern[ind - 1] = value
+        else:
+            TwoDController.SetAxisPar(self, ind, par_name, value)
 
     def GetExtraAttributePar(self, ind, name):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In GetExtraFeaturePar method for index",ind," name=",name
         if self.device_available[ind - 1]:
             if name == "TangoDevice":
-                tango_device = (
-                    self.node + ":" + str(self.port) + "/" + self.proxy[ind - 1].name()
+                tango_device = full_device_name(
+                    self.TangoHost, self.tango_device[ind - 1]
                 )
                 return tango_device
+            elif name == "BytesCopied":
+                return self.bytes_copied[ind - 1]
+            elif name == "StateRoundTripsAvoided":
+                return self.round_trips_avoided[ind - 1]
+            elif name == "StateLatency":
+                return self.state_latency[ind - 1]
+            elif name == "SequenceMode":
+                return self.sequence_mode[ind - 1]
+            elif name == "FramesReceived":
+                return self.frames_received[ind - 1]
+            elif name == "ROIs":
+                rois = {}
+                for roi, rect in zip(self.roi_names[ind - 1], self.roi_rects[ind - 1]):
+                    rois[roi] = [rect.tolist()]
+                return json.dumps(rois)
+            elif name == "FrameOutput":
+                return self.frame_output[ind - 1]
+            elif name == "H5Compression":
+                return self.h5_compression[ind - 1]
+            elif name == "H5ChunkRows":
+                return self.h5_chunk_rows[ind - 1]
+            elif name == "LiveView":
+                return self.live_view[ind - 1]
+            elif name == "LiveBinning":
+                return self.live_binning[ind - 1]
+            elif name == "LiveFramesDropped":
+                publisher = LIVE_PUBLISHERS.get(self.LiveViewEndpoint)
+                return publisher.dropped if publisher is not None else 0
+            elif name == "DarkSubtraction":
+                return self.dark_subtraction[ind - 1]
+            elif name == "DarkMode":
+                return self.dark_mode[ind - 1]
+            elif name == "DarkRecord":
+                return self.dark_record[ind - 1]
+            elif name == "DarkExposure":
+                return self.dark_exposure[ind - 1]
+            elif name == "StatePolls":
+                return self.state_polls[ind - 1]
+            elif name == "Accumulation":
+                return self.accumulation[ind - 1]
+            elif name == "AccumulationStats":
+                stats = self.acc_stats[ind - 1]
+                return json.dumps(
+                    {
+                        "frames": len(stats),
+                        "mean": [mean for mean, peak in stats],
+                        "max": [peak for mean, peak in stats],
+                    }
+                )
+            elif name == "DarkAge":
+                exposure = self.dark_exposure[ind - 1] or self.exposure_loaded[ind - 1]
+                if exposure is None:
+                    return -1.0
+                age = self.darks.age(
+                    self.tango_device[ind - 1], exposure, self.dark_mode[ind - 1]
+                )
+                return -1.0 if age is None else age
 
     def SetExtraAttributePar(self, ind, name, value):
         #        print "PYTHON -> TangoVimbaCtrl/",self.inst_name,": In SetExtraFeaturePar method for index",ind," name=",name," value=",value
-        pass
+        if name == "SequenceMode":
+            self.sequence_mode[ind - 1] = bool(value)
+        elif name == "ROIs":
+            self.set_rois(ind, json.loads(value or "{}"))
+        elif name == "FrameOutput":
+            self.frame_output[ind - 1] = bool(value)
+        elif name == "H5Compression":
+            self.h5_compression[ind - 1] = value
+        elif name == "H5ChunkRows":
+            self.h5_chunk_rows[ind - 1] = int(value)
+        elif name == "LiveView":
+            if value:
+                # fail here, not at the next read, without pyzmq
+                live_publisher(self.LiveViewEndpoint, self.LiveViewRing)
+            self.live_view[ind - 1] = bool(value)
+        elif name == "LiveBinning":
+            if int(value) < 1:
+                raise ValueError("LiveBinning must be at least 1")
+            self.live_binning[ind - 1] = int(value)
+        elif name == "DarkSubtraction":
+            self.dark_subtraction[ind - 1] = bool(value)
+        elif name == "DarkMode":
+            self.dark_mode[ind - 1] = value
+        elif name == "DarkExposure":
+            self.dark_exposure[ind - 1] = float(value)
+        elif name == "Accumulation":
+            if int(value) < 1:
+                raise ValueError("Accumulation must be at least 1")
+            self.accumulation[ind - 1] = int(value)
+            # a new count applies from the next start, never to an old sum
+            self.acc_count[ind - 1] = 0
+            self.acc_active[ind - 1] = False
+        elif name == "DarkRecord":
+            if self.dark_record[ind - 1] and not value:
+                self._store_dark(ind)
+            else:
+                self.dark_sum[ind - 1] = None
+                self.dark_count[ind - 1] = 0
+            self.dark_record[ind - 1] = bool(value)
 
     def SendToCtrl(self, in_data):
         #        print "Received value =",in_data
@@ -177,5 +1518,110 @@ class TangoVimbaController(TwoDController):
         print("PYTHON -> TangoVimbaCtrl/", self.inst_name, ": dying")
 
 
+class TangoVimbaROICounterController(CounterTimerController):
+    """ROI sums or means of a TangoVimba camera as counter channels.
+
+    The ROIs are set on the TwoD channel of the camera (ROIs attribute, see
+    the roi_apply macro) and reduced by TangoVimbaController as each frame is
+    read. Axis n reports the n-th ROI in name order unless its ROIName is
+    set. The axes are MOVING until the frame of the last start of the camera
+    is taken, so they are never read from the previous frame. With
+    FrameOutput disabled on the TwoD channel only these scalars are recorded.
+    Software synchronized acquisitions only.
+    """
+
+    ctrl_extra_attributes = {
+        "ROIName": {Type: "PyTango.DevString", Access: ReadWrite},
+        "Reduction": {Type: "PyTango.DevString", Access: ReadWrite},
+    }
+
+    class_prop = {
+        "VimbaDevice": {
+            Type: str,
+            Description: "The TangoVimba device (as TangoDevice of its TwoD channel)",
+        },
+    }
+
+    MaxDevice = 97
+
+    def __init__(self, inst, props, *args, **kwargs):
+        CounterTimerController.__init__(self, inst, props, *args, **kwargs)
+        self.roi_name = {}
+        self.reduction = {}
+
+    def AddDevice(self, ind):
+        self.roi_name[ind] = ""
+        self.reduction[ind] = "sum"
+
+    def DeleteDevice(self, ind):
+        self.roi_name.pop(ind, None)
+        self.reduction.pop(ind, None)
+
+    def _roi_index(self, ind):
+        """Index of the ROI of axis ind on its camera, and the error if none."""
+        ctrl, axis = VIMBA_AXES[self.VimbaDevice]
+        names = ctrl.roi_names[axis - 1]
+        name = self.roi_name[ind]
+        if name:
+            if name not in names:
+                return None, "ROI %s not defined on %s (ROIs: %s)" % (
+                    name,
+                    self.VimbaDevice,
+                    ", ".join(names) or "none",
+                )
+            return names.index(name), ""
+        if ind > len(names):
+            return None, "Only %d ROIs defined on %s, set ROIName of axis %d" % (
+                len(names),
+                self.VimbaDevice,
+                ind,
+            )
+        return ind - 1, ""
+
+    def StateOne(self, ind):
+        if self.VimbaDevice not in VIMBA_AXES:
+            return (State.Fault, "No TangoVimbaController axis for " + self.VimbaDevice)
+        idx, error = self._roi_index(ind)
+        if idx is None:
+            return (State.Fault, error)
+        ctrl, axis = VIMBA_AXES[self.VimbaDevice]
+        if ctrl.frame_pending(axis):
+            return (State.Moving, "Camera acquiring")
+        return (State.On, "ROI ready")
+
+    def LoadOne(self, ind, value, repetitions, latency):
+        pass
+
+    def StartOne(self, ind, value=None):
+        pass
+
+    def ReadOne(self, ind):
+        ctrl, axis = VIMBA_AXES[self.VimbaDevice]
+        ctrl.reduce_frame(axis)
+        idx, error = self._roi_index(ind)
+        if idx is None:
+            raise ValueError(error)
+        if self.reduction[ind] == "mean":
+            return float(ctrl.roi_means[axis - 1][idx])
+        return float(ctrl.roi_sums[axis - 1][idx])
+
+    def AbortOne(self, ind):
+        pass
+
+    def GetExtraAttributePar(self, ind, name):
+        if name == "ROIName":
+            return self.roi_name[ind]
+        elif name == "Reduction":
+            return self.reduction[ind]
+
+    def SetExtraAttributePar(self, ind, name, value):
+        if name == "ROIName":
+            self.roi_name[ind] = value
+        elif name == "Reduction":
+            if value not in ("sum", "mean"):
+                raise ValueError("Reduction must be 'sum' or 'mean'")
+            self.reduction[ind] = value
+
+
 if __name__ == "__main__":
     obj = TwoDController("test")
@@ -0,0 +1,138 @@
+import time
+
+
+ACQ_CONF_DEFAULTS = {
+    "waitTime": 0.0,
+    "checkTape": False,
+    "checkTarget": False,
+    "checkCamTemp": False,
+    "checkPressure": False,
+    "startTape": False,
+    "stopTape": False,
+    "startTarget": False,
+    "stopTarget": False,
+    "autoModeLaser": False,
+    "darkModeLaser": False,
+    "autoShutterPump": False,
+}
+
+
+class AcqConf(object):
+    """Validated snapshot of the acqConf environment variable.
+
+    Every key of ACQ_CONF_DEFAULTS is an attribute; keys missing in the
+    environment get their default and are listed in missing. Other keys are
+    kept untouched in extra.
+    """
+
+    def __init__(self, env):
+        self.missing = []
+        self.extra = dict(
+            (key, value) for key, value in env.items() if key not in ACQ_CONF_DEFAULTS
+        )
+        for key, default in ACQ_CONF_DEFAULTS.items():
+            if key in env:
+                value = env[key]
+            else:
+                value = default
+                self.missing.append(key)
+            if isinstance(default, bool):
+                value = bool(value)
+            else:
+                value = float(value)
+                if value < 0:
+                    raise ValueError("acqConf/%s must not be negative" % key)
+            setattr(self, key, value)
+
+    def as_dict(self):
+        conf = dict(self.extra)
+        conf.update((key, getattr(self, key)) for key in ACQ_CONF_DEFAULTS)
+        return conf
+
+
+_acq_conf = None
+
+
+def load_acq_conf(macro):
+    """Read acqConf from the environment and cache it for the hooks.
+
+    Keys missing in the stored acqConf (e.g. added by a newer version of
+    the hooks) are stored once with their default.
+    """
+    global _acq_conf
+    try:
+        env = macro.getEnv("acqConf")
+    except:
+        env = {}
+    _acq_conf = AcqConf(env)
+    if _acq_conf.missing:
+        macro.setEnv("acqConf", _acq_conf.as_dict())
+        macro.info(
+            "acqConf completed with the defaults of %s" % ", ".join(_acq_conf.missing)
+        )
+    return _acq_conf
+
+
+def get_acq_conf(macro):
+    """The cached acqConf, read from the environment on first use.
+
+    The cache is refreshed at every user_pre_scan and whenever acqConf is
+    changed with set_acq_conf.
+    """
+    if _acq_conf is None:
+        return load_acq_conf(macro)
+    return _acq_conf
+
+
+def set_acq_conf(macro, conf):
+    """Write the acqConf dict conf to the environment and to the cache."""
+    global _acq_conf
+    _acq_conf = AcqConf(conf)
+    macro.setEnv("acqConf", _acq_conf.as_dict())
+
+
+_motion_end = 0.0
+_last_acq = 0.0
+
+
+def mark_motion_end():
+    """Start the settle timer of the next acquisition (from user_post_move).
+
+    user_post_move only runs when it is a general post-move hook, see
+    register_post_move_hook.
+    """
+    global _motion_end
+    _motion_end = time.time()
+
+
+def settle_deadline(wait_time):
+    """Time at which the acquisition may start after a settle of wait_time.
+
+    The settle timer runs from the end of the last motion if there was one
+    since the previous acquisition, otherwise from now.
+    """
+    global _last_acq
+    now = time.time()
+    start = _motion_end if _motion_end > _last_acq else now
+    _last_acq = now
+    return start + wait_time
+
+
+def register_post_move_hook(macro):
+    """Add user_post_move to the general post-move hooks if it is missing.
+
+    Without it the settle timer starts in user_pre_acq instead of at the end
+    of the motion. The general hooks are read when a scan starts, so a hook
+    added here runs from the next scan on. Returns whether it was added.
+    """
+    try:
+        hooks = list(macro.getEnv("_GeneralHooks"))
+    except:
+        hooks = []
+    for name, places in hooks:
+        if name == "user_post_move" and "post-move" in places:
+            return False
+    hooks.append(("user_post_move", ["post-move"]))
+    macro.setEnv("_GeneralHooks", hooks)
+    macro.info("user_post_move registered as general post-move hook")
+    return True
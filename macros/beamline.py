@@ -1,7 +1,10 @@
 from sardana.macroserver.macro import Macro, macro, imacro, Type
 import tango
 from time import sleep
-import subprocess
+
+from health import PRESSURE_GAUGES, run_checks
+from mirror import get_mirror
+from orchestration import Step, run_steps
 
 
 
@@ -26,65 +29,28 @@ def switch_to_mte(self):
     self.output("switching to mte ccd detector...")
     # self.output("driving ccd in")
     # self.execMacro("ccd_in")
-    self.output("switching measurement group to spectroscopy")
-    self.execMacro("set_meas", "spectroscopy_mgmt")
-    self.output("switching PiLCTimerCtrl.TriggerMode to 3")
-    pilc = self.getController("PiLCTimerCtrl_spec")
-    pilc.write_attribute("triggermode", 3)
-    self.output(f"triggermode = %d" % pilc.read_attribute("triggermode").value)
-    self.output("exporting acqconf to check mte CamTemp")
-    # args are boolean: checkTape, checkTarget, checkCamTemp, startTape, stopTape, startTarget, stopTarget, autoModeLaser, darkModeLaser, autoShutterPump
-    self.execMacro("acqconf", 1, 1, 1, 1, 1, 1, 1, 1, 0, 0)
+    self.execMacro("profile_apply", "mte")
     self.output("don't forget to switch\nLaVue Tango Events -> Attributes to rsxs mte")
 
 @macro()
 def switch_to_pilc_only(self):
-    self.output("switching measurement group to pilc_only")
-    self.execMacro("set_meas", "pilc_only")
-    self.output("switching PiLCTimerCtrl.TriggerMode to 1")
-    pilc = self.getController("PiLCTimerCtrl_spec")
-    pilc.write_attribute("triggermode", 1)
-    self.output(f"triggermode = %d" % pilc.read_attribute("triggermode").value)
-    # args are boolean: checkTape, checkTarget, checkCamTemp, startTape, stopTape, startTarget, stopTarget, autoModeLaser, darkModeLaser, autoShutterPump
-    self.execMacro("acqconf", 1, 1, 0, 1, 1, 1, 1, 1, 0, 0)
-@macro()
-def pressure_check(self):
-    try:
-        pressure_ccd = tango.DeviceProxy("spec/TPG261/ccd").pressure
-    except:
-        pressure_ccd = 9999.0
-    try:
-        pressure_pxs = tango.DeviceProxy("sxr/TPG261/pxs").pressure
-    except:
-        pressure_pxs = 9999.0
-    try:
-        pressure_optics = tango.DeviceProxy("spec/TPG261/optic").pressure
-    except:
-        pressure_optics = 9999.0
+    self.execMacro("profile_apply", "pilc_only")
 
+@macro([["max_age", Type.Float, 0.0, "reuse readings younger than max_age [s]"]])
+def pressure_check(self, max_age):
+    results = run_checks(PRESSURE_GAUGES, max_age=max_age)
 
-    p_pxs = 1.0e-5     # ideally 1e-5
-    p_ccd = 1.0e-6     # ideally 1e-6
-    p_optics = 1.0e-5  # ideally 1e-5
+    for i, result in enumerate(results):
+        if i:
+            self.output("==========")
+        self.output("%s <%0.1e?" % (result.name, result.limit))
+        if result.error:
+            self.warning("%s: %s" % (result.device, result.error))
+        else:
+            self.output(result.value)
+        self.output(result.ok)
 
-    self.output("pxs <%0.1e?" % p_pxs)
-    self.output(pressure_pxs)
-    self.output(pressure_pxs < p_pxs)
-    self.output("==========")
-
-    self.output("CCD <%0.1e?" % p_ccd)
-    self.output(pressure_ccd)
-    self.output(pressure_ccd < p_ccd)
-    self.output("==========")
-
-    self.output("Optics <%0.1e?" % p_optics)
-    self.output(pressure_optics)
-    self.output(pressure_optics < p_optics)
-
-    if pressure_pxs < p_pxs and pressure_ccd < p_ccd and pressure_optics < p_optics:
-        return True
-    else:
-        return False
+    return all(result.ok for result in results)
 
 @macro()
 def start_puzzing_all(self):
@@ -108,66 +74,67 @@ def stop_puzzing(self):
 def sync(self):
     scanDir = self.getEnv("ScanDir")
     self.output("synchronize data to NAS")
-    result = subprocess.run(
-    f'rsync -r -t -g -v --progress -s {scanDir} data_ampere@nasbsxr.sxr.lab:/share/Data/henryetta.sxr.lab/spectroscopy',shell = True, stdout=subprocess.PIPE,)
-    self.output(result.stdout.decode("utf-8"))
+    try:
+        queued = get_mirror().enqueue(scanDir)
+    except ValueError as e:
+        self.error(str(e))
+        return
+    if queued:
+        self.output("queued %s for mirroring, see mirror_status" % scanDir)
+    else:
+        self.output("%s is already queued for mirroring" % scanDir)
 
 
-@macro()
-def end_of_the_day(self):
-    self.output("Running end_of_the_day in 5s:")
+@macro([["countdown", Type.Integer, 5, "seconds to abort before starting"]])
+def end_of_the_day(self, countdown):
+    self.output("Running end_of_the_day in %ds:" % countdown)
 
-    for i in range(5):
+    for i in range(countdown):
         self.output((i + 1) * ".")
         sleep(1)
 
-    self.execMacro("umv", "thindisk_laser_wp", "0")
-
-    try:
-        self.execMacro("tape_off")
-        self.execMacro("target_off")
-    except:
-        self.warning("Tape and/or target could not be turned off!")
+    def move_to_zero(name):
+        # the Motion is registered with this macro, so stopping or aborting
+        # end_of_the_day also stops the move running in the worker thread
+        motion = self.getMotion([name])
+        return lambda: motion.move([0])
 
-    try:
-        self.execMacro("laser_sleep_mode")
-        self.execMacro("shutter_disable")
-        self.execMacro("shutter_manual")  
-        self.execMacro("laser_off")
-    except:
-        self.warning("Shutter and/or flipmounts did not close properly! Manually disable the shutter!")
-
-    self.output("CAUTION! PUMP BEAM MAY BE NOT BLOCKED!!!!!!!")
-
-    try:
-        self.execMacro("umv", "mag_curr_spec", "0")
-    except:
-        self.output("Magnet can not be turned off. CaenFastPS off?")
-
-
-    try:
-        self.execMacro("mte_temp_set", 19)
-    except:
-        self.warning("Could not contact CCD to heat to 19 degrees C")
-
-
-    try:
-        self.execMacro("pressure_check")
-    except:
-        self.warning("Could not get pressures.")
-
-    
-    try:
-        self.execMacro("sync")
-    except:
-        self.warning("Sync data")
-    
-    try:
-        self.execMacro("start_puzzing_all")
-    except:
-        self.warning("Could not contact Puzzi properly.")
-
-    
+    def run(*args):
+        return lambda: self.execMacro(*args)
 
+    def pressures():
+        for result in run_checks(PRESSURE_GAUGES):
+            if not result.ok:
+                raise RuntimeError("%s: %s" % (result.name, result.error or result.value))
 
+    scanDir = self.getEnv("ScanDir")
 
+    # macros run one by one on the macro thread, moves and Tango calls in
+    # parallel; deps keep the laser/shutter sequence in its safe order
+    steps = [
+        Step("waveplate to 0", move_to_zero("thindisk_laser_wp"), threaded=True),
+        Step("magnet to 0", move_to_zero("mag_curr_spec"), threaded=True),
+        Step("sync", lambda: get_mirror().enqueue(scanDir), threaded=True),
+        Step("tape off", run("tape_off")),
+        Step("target off", run("target_off")),
+        Step("laser sleep", run("laser_sleep_mode"), deps=["waveplate to 0"]),
+        Step("shutter disable", run("shutter_disable"), deps=["laser sleep"]),
+        Step("shutter manual", run("shutter_manual"), deps=["shutter disable"]),
+        Step("laser off", run("laser_off"), deps=["shutter manual"]),
+        Step("ccd to 19 C", run("mte_temp_set", 19)),
+        Step("pressures", pressures, threaded=True),
+        # the cleaning robot only runs once the laser is off
+        Step("puzzi", run("start_puzzing_all"), deps=["laser off"]),
+    ]
+    results = run_steps(steps, check_point=self.checkPoint)
+
+    self.output("%-16s %-8s %8s  %s" % ("step", "status", "time [s]", "error"))
+    for result in results:
+        self.output(
+            "%-16s %-8s %8.1f  %s"
+            % (result.name, result.status, result.duration, result.error)
+        )
+    status = dict((result.name, result.status) for result in results)
+    if status["laser off"] != "ok":
+        self.warning("Shutter and/or flipmounts did not close properly! Manually disable the shutter!")
+    self.output("CAUTION! PUMP BEAM MAY BE NOT BLOCKED!!!!!!!")
@@ -0,0 +1,178 @@
+import numpy as np
+import tango
+
+from health import get_proxy
+
+WAVEPLATE = "thindisk_laser_wp"
+POWER_CTRL = "pm/powerctrl/1"
+FLUENCE_CTRL = "pm/fluencectrl/1"
+POWER_ATTRIBUTES = ["P0", "Pm", "offset", "period"]
+FLUENCE_ATTRIBUTES = ["pumpHor", "pumpVer", "refl", "repRate"]
+FLUENCE_DEFAULTS = {"pumpHor": 100.0, "pumpVer": 100.0, "refl": 0.0, "repRate": 3000.0}
+LUT_POINTS = 2001
+# largest difference to the power pseudo motor accepted, as a fraction of Pm
+POWER_TOLERANCE = 1e-3
+
+
+def read_parameters(device, attributes):
+    """Read attributes of device with a single read_attributes call."""
+    values = get_proxy(device).read_attributes(attributes)
+    return dict((name, value.value) for name, value in zip(attributes, values))
+
+
+def write_parameters(device, parameters):
+    get_proxy(device).write_attributes(list(parameters.items()))
+
+
+class PowerCalibration(object):
+    """Pump power behind the waveplate of the power pseudo motor.
+
+    power = P0 + Pm * sin(period * (angle - offset))^2, angle in deg and
+    power in W, with the parameters of the pseudo motor. The formula mirrors
+    PowerPseudoMotorController, which lives outside this repository;
+    compare_power checks it against the pseudo motor before fluencescan maps
+    fluences to angles with it. The inverse is looked up in a table over the rising branch of
+    the first period after offset.
+    """
+
+    def __init__(self, P0, Pm, offset, period, lut_points=LUT_POINTS):
+        self.P0 = float(P0)
+        self.Pm = float(Pm)
+        self.offset = float(offset)
+        self.period = float(period)
+        if self.period > 0:
+            self.lut_angle = self.offset + np.linspace(
+                0.0, 90.0 / self.period, lut_points
+            )
+        else:
+            self.lut_angle = np.full(lut_points, self.offset)
+        self.lut_power = self.power(self.lut_angle)
+
+    def power(self, angle):
+        phase = np.radians(self.period * (np.asarray(angle, dtype=float) - self.offset))
+        return self.P0 + self.Pm * np.sin(phase) ** 2
+
+    def angle(self, power):
+        """Waveplate angle of power (array or scalar), on the rising branch."""
+        power = np.asarray(power, dtype=float)
+        if np.any(power < self.P0) or np.any(power > self.P0 + self.Pm):
+            raise ValueError(
+                "power outside [%g, %g] W" % (self.P0, self.P0 + self.Pm)
+            )
+        return np.interp(power, self.lut_power, self.lut_angle)
+
+    @property
+    def limits(self):
+        return self.P0, self.P0 + self.Pm
+
+
+class FluenceCalibration(object):
+    """Pump fluence in mJ/cm^2 of a pump power in W.
+
+    Beam diameters (FWHM) in um, reflectivity in %, repetition rate in Hz.
+    """
+
+    def __init__(self, pumpHor, pumpVer, refl, repRate):
+        self.pumpHor = float(pumpHor)
+        self.pumpVer = float(pumpVer)
+        self.refl = float(refl)
+        self.repRate = float(repRate)
+        area = np.pi * self.pumpHor / 10000 / 2 * self.pumpVer / 10000 / 2
+        self.factor = (1 - self.refl / 100) / (self.repRate / 1000 * area)
+
+    def fluence(self, power):
+        return np.asarray(power, dtype=float) * self.factor
+
+    def power(self, fluence):
+        return np.asarray(fluence, dtype=float) / self.factor
+
+
+class Calibration(object):
+    """Waveplate angle, power and fluence mapped onto each other."""
+
+    def __init__(self, power, fluence):
+        self.power_cal = power
+        self.fluence_cal = fluence
+        self._power_warning = None
+
+    def fluence(self, angle):
+        return self.fluence_cal.fluence(self.power_cal.power(angle))
+
+    def angle(self, fluence):
+        return self.power_cal.angle(self.fluence_cal.power(fluence))
+
+    @property
+    def fluence_limits(self):
+        return tuple(self.fluence_cal.fluence(self.power_cal.limits))
+
+    def power_warning(self):
+        """compare_power of the power calibration, asked once per load."""
+        if self._power_warning is None:
+            self._power_warning = compare_power(self.power_cal)
+        return self._power_warning
+
+
+def compare_power(power, device=POWER_CTRL, nb_angles=5):
+    """Compare power with the power pseudo motor, return a warning or "".
+
+    The pseudo motor computes the power of nb_angles waveplate angles spread
+    over the calibrated branch (its CalcPseudo command); they should agree
+    with PowerCalibration.power within POWER_TOLERANCE * Pm.
+    """
+    angles = np.linspace(power.lut_angle[0], power.lut_angle[-1], nb_angles)
+    try:
+        proxy = get_proxy(device)
+        actual = np.array(
+            [proxy.command_inout("CalcPseudo", [angle]) for angle in angles]
+        )
+    except tango.DevFailed as e:
+        return "power calibration not checked, %s: %s" % (device, e.args[0].desc)
+    deviation = np.max(np.abs(actual - power.power(angles)))
+    if deviation > POWER_TOLERANCE * abs(power.Pm):
+        return (
+            "power calibration differs from %s by up to %g W, the fluences "
+            "may be off" % (device, deviation)
+        )
+    return ""
+
+
+_calibration = None
+
+
+def load_calibration():
+    """Read the parameters of the power and fluence pseudo motors."""
+    global _calibration
+    power = PowerCalibration(**read_parameters(POWER_CTRL, POWER_ATTRIBUTES))
+    fluence = FluenceCalibration(
+        **read_parameters(FLUENCE_CTRL, FLUENCE_ATTRIBUTES)
+    )
+    _calibration = Calibration(power, fluence)
+    return _calibration
+
+
+def get_calibration():
+    """The cached calibration, read from the pseudo motors on first use.
+
+    powerconf and fluenceconf reset it when they change the parameters.
+    """
+    if _calibration is None:
+        return load_calibration()
+    return _calibration
+
+
+def reset_calibration():
+    """Drop the cached calibration, read again at the next get_calibration."""
+    global _calibration
+    _calibration = None
+
+
+def travel_order(angles, position):
+    """Indices of angles sorted for the shortest travel from position.
+
+    The waveplate sweeps the points once, starting at the end closest to
+    position.
+    """
+    order = np.argsort(angles)
+    if abs(angles[order[-1]] - position) < abs(angles[order[0]] - position):
+        order = order[::-1]
+    return order
@@ -1,6 +1,17 @@
 from sardana.macroserver.macro import imacro, macro, Type, Optional
-from tango import DeviceProxy
-import numpy as np
+
+from acquisition import get_acq_conf, set_acq_conf
+from calibration import (
+    FLUENCE_ATTRIBUTES,
+    FLUENCE_CTRL,
+    FLUENCE_DEFAULTS,
+    POWER_ATTRIBUTES,
+    POWER_CTRL,
+    FluenceCalibration,
+    read_parameters,
+    reset_calibration,
+    write_parameters,
+)
 
 
 @imacro(
@@ -33,10 +44,7 @@ def acqconf(
     waitTime,
 ):
     # run all the other configurations
-    try:
-        acqConf = self.getEnv("acqConf")
-    except:
-        acqConf = {}
+    acqConf = get_acq_conf(self).as_dict()
 
     if checkTape is None:
         checkTape = self.input(
@@ -130,7 +138,7 @@ def acqconf(
     acqConf["darkModeLaser"] = darkModeLaser
     acqConf["autoShutterPump"] = autoShutterPump
 
-    self.setEnv("acqConf", acqConf)
+    set_acq_conf(self, acqConf)
 
     self.execMacro("waittime", waitTime)
 
@@ -142,7 +150,7 @@ def acqconf(
 
 @macro()
 def acqrep(self):
-    acqConf = self.getEnv("acqConf")
+    acqConf = get_acq_conf(self).as_dict()
     self.output(
         "Gen. Settings:\nWaittime = %.2f s | check tape: %r | check target: %r | check cam temp: %r\nstart tape: %r | stop tape: %r |start target: %r | stop target: %r\nauto mode laser: %r",
         acqConf["waitTime"],
@@ -162,7 +170,7 @@ def acqrep(self):
 @imacro([["time", Type.Float, Optional, "time in seconds"]])
 def waittime(self, time):
     """Macro waittime"""
-    acqConf = self.getEnv("acqConf")
+    acqConf = get_acq_conf(self).as_dict()
 
     if time is None:
         label, unit = "Waittime", "s"
@@ -178,7 +186,7 @@ def waittime(self, time):
         )
 
     acqConf["waitTime"] = time
-    self.setEnv("acqConf", acqConf)
+    set_acq_conf(self, acqConf)
     self.output("waittime set to %.2f s", time)
 
 
@@ -191,17 +199,10 @@ def waittime(self, time):
     ]
 )
 def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
-    fluencePM = DeviceProxy("pm/fluencectrl/1")
     try:
-        lastPumpHor = fluencePM.pumpHor
-        lastPumpVer = fluencePM.pumpVer
-        lastRefl = fluencePM.refl
-        lastRepRate = fluencePM.repRate
+        last = read_parameters(FLUENCE_CTRL, FLUENCE_ATTRIBUTES)
     except:
-        lastPumpHor = 100
-        lastPumpVer = 100
-        lastRefl = 0
-        lastRepRate = 3000
+        last = dict(FLUENCE_DEFAULTS)
 
     if pumpHor is None:
         label, unit = "hor", "um"
@@ -211,7 +212,7 @@ def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
             title="Horizontal beam diameter",
             key=label,
             unit=unit,
-            default_value=lastPumpHor,
+            default_value=last["pumpHor"],
             minimum=0.0,
             maximum=100000,
         )
@@ -223,7 +224,7 @@ def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
             title="Vertical beam diameter",
             key=label,
             unit=unit,
-            default_value=lastPumpVer,
+            default_value=last["pumpVer"],
             minimum=0.0,
             maximum=100000,
         )
@@ -235,7 +236,7 @@ def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
             title="Sample reflectivity",
             key=label,
             unit=unit,
-            default_value=lastRefl,
+            default_value=last["refl"],
             minimum=0.0,
             maximum=100,
         )
@@ -247,31 +248,21 @@ def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
             title="Laser repetition rate",
             key=label,
             unit=unit,
-            default_value=lastRepRate,
+            default_value=last["repRate"],
             minimum=0.0,
             maximum=10000,
         )
 
-    fluencePM.pumpHor = pumpHor
-    fluencePM.pumpVer = pumpVer
-    fluencePM.refl = refl
-    fluencePM.repRate = repRate
+    write_parameters(
+        FLUENCE_CTRL,
+        {"pumpHor": pumpHor, "pumpVer": pumpVer, "refl": refl, "repRate": repRate},
+    )
+    reset_calibration()
+    fluenceCal = FluenceCalibration(pumpHor, pumpVer, refl, repRate)
 
     power = self.getPseudoMotor("power")
     fluence = self.getPseudoMotor("fluence")
-    minPower, maxPower = power.getPositionObj().getLimits()
-
-    trans = 1 - (refl / 100)
-    minFluence = (
-        minPower
-        * trans
-        / (repRate / 1000 * np.pi * pumpHor / 10000 / 2 * pumpVer / 10000 / 2)
-    )
-    maxFluence = (
-        maxPower
-        * trans
-        / (repRate / 1000 * np.pi * pumpHor / 10000 / 2 * pumpVer / 10000 / 2)
-    )
+    minFluence, maxFluence = fluenceCal.fluence(power.getPositionObj().getLimits())
     self.info("Update limits of pseudo motor fluence")
     fluence.getPositionObj().setLimits(minFluence, maxFluence)
 
@@ -280,20 +271,15 @@ def fluenceconf(self, pumpHor, pumpVer, refl, repRate):
 
 @macro()
 def fluencerep(self):
-    fluencePM = DeviceProxy("pm/fluencectrl/1")
-
-    pumpHor = fluencePM.pumpHor
-    pumpVer = fluencePM.pumpVer
-    refl = fluencePM.refl
-    repRate = fluencePM.repRate
+    params = read_parameters(FLUENCE_CTRL, FLUENCE_ATTRIBUTES)
 
     self.output(
         "Fluence Settings: pumpHor = %.2f um | pumpVer = %.2f um |"
         "refl = %.2f %% | repRate = %.2f Hz",
-        pumpHor,
-        pumpVer,
-        refl,
-        repRate,
+        params["pumpHor"],
+        params["pumpVer"],
+        params["refl"],
+        params["repRate"],
     )
 
     fluence = self.getPseudoMotor("fluence")
@@ -316,7 +302,7 @@ def fluencerep(self):
 )
 def powerconf(self, P0, Pm, offset, period):
     """This sets the parameters of the power pseudo motor"""
-    power = DeviceProxy("pm/powerctrl/1")
+    last = read_parameters(POWER_CTRL, POWER_ATTRIBUTES)
 
     if P0 is None:
         label, unit = "P0", "W"
@@ -326,7 +312,7 @@ def powerconf(self, P0, Pm, offset, period):
             title="Minimum Power",
             key=label,
             unit=unit,
-            default_value=power.P0,
+            default_value=last["P0"],
             minimum=0.0,
             maximum=100000,
         )
@@ -339,7 +325,7 @@ def powerconf(self, P0, Pm, offset, period):
             title="Maximum Power",
             key=label,
             unit=unit,
-            default_value=power.Pm,
+            default_value=last["Pm"],
             minimum=0.0,
             maximum=100000,
         )
@@ -352,7 +338,7 @@ def powerconf(self, P0, Pm, offset, period):
             title="Radial Offset",
             key=label,
             unit=unit,
-            default_value=power.offset,
+            default_value=last["offset"],
             minimum=-45,
             maximum=45,
         )
@@ -365,16 +351,16 @@ def powerconf(self, P0, Pm, offset, period):
             title="Radial Period",
             key=label,
             unit=unit,
-            default_value=power.period,
+            default_value=last["period"],
             minimum=0,
             maximum=2,
         )
 
     self.info("Update parameters of pseudo motor power")
-    power.offset = offset
-    power.period = period
-    power.P0 = P0
-    power.Pm = Pm
+    write_parameters(
+        POWER_CTRL, {"offset": offset, "period": period, "P0": P0, "Pm": Pm}
+    )
+    reset_calibration()
 
     self.execMacro("set_lim", "power", P0, (Pm + P0))
     self.execMacro("powerrep")
@@ -383,14 +369,14 @@ def powerconf(self, P0, Pm, offset, period):
 @macro()
 def powerrep(self):
     # return all powerconf values
-    power = DeviceProxy("pm/powerctrl/1")
+    params = read_parameters(POWER_CTRL, POWER_ATTRIBUTES)
     self.output(
         "Power Settings  : P0 = %.4f W | Pm = %.4f W |"
         "offset = %.2f deg | period = %.2f",
-        power.P0,
-        power.Pm,
-        power.offset,
-        power.period,
+        params["P0"],
+        params["Pm"],
+        params["offset"],
+        params["period"],
     )
 
 
@@ -0,0 +1,83 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import tango
+
+# name, device, attribute, upper limit
+PRESSURE_GAUGES = [
+    ("pxs", "sxr/TPG261/pxs", "pressure", 1.0e-5),  # ideally 1e-5
+    ("ccd", "spec/TPG261/ccd", "pressure", 1.0e-6),  # ideally 1e-6
+    ("optics", "spec/TPG261/optic", "pressure", 1.0e-5),  # ideally 1e-5
+]
+
+CheckResult = namedtuple(
+    "CheckResult", "name device value limit ok error latency timestamp"
+)
+
+_proxies = {}
+_proxies_lock = threading.Lock()
+_results = {}
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="health")
+
+
+def get_proxy(device, timeout=None):
+    """Cached DeviceProxy of device, shared by all macros of the MacroServer.
+
+    timeout (in s) sets the Tango timeout of the proxy.
+    """
+    with _proxies_lock:
+        proxy = _proxies.get(device)
+    if proxy is None:
+        proxy = tango.DeviceProxy(device)
+        with _proxies_lock:
+            proxy = _proxies.setdefault(device, proxy)
+    if timeout is not None:
+        proxy.set_timeout_millis(int(timeout * 1000))
+    return proxy
+
+
+def drop_proxy(device):
+    with _proxies_lock:
+        _proxies.pop(device, None)
+
+
+def _read(check, timeout):
+    name, device, attribute, limit = check
+    t0 = time.time()
+    try:
+        value = get_proxy(device, timeout).read_attribute(attribute).value
+    except Exception as e:
+        # a new proxy is built on the next check, e.g. after a server restart
+        drop_proxy(device)
+        if isinstance(e, tango.DevFailed):
+            error = e.args[0].desc
+        else:
+            error = str(e)
+        t1 = time.time()
+        return CheckResult(name, device, None, limit, False, error, t1 - t0, t1)
+    t1 = time.time()
+    return CheckResult(name, device, value, limit, value < limit, "", t1 - t0, t1)
+
+
+def run_checks(checks, timeout=1.0, max_age=0.0):
+    """Read all checks concurrently and compare them with their limits.
+
+    checks are (name, device, attribute, upper limit) tuples. Each device
+    gets at most timeout seconds, so one unresponsive gauge does not delay
+    the others. Results younger than max_age seconds are reused, which
+    makes the checks cheap enough to run at every scan point.
+    """
+    now = time.time()
+    results = {}
+    pending = []
+    for check in checks:
+        cached = _results.get(check)
+        if cached is not None and now - cached.timestamp < max_age:
+            results[check] = cached
+        else:
+            pending.append((check, _executor.submit(_read, check, timeout)))
+    for check, future in pending:
+        results[check] = _results[check] = future.result()
+    return [results[check] for check in checks]
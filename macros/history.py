@@ -0,0 +1,296 @@
+from sardana.macroserver.macro import macro, Type
+from datetime import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# next to the macroserver.properties environment, unless ScanHistoryDB is set
+HISTORY_DB = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "scan_history.sqlite"
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    serialno INTEGER,
+    startts REAL,
+    endts REAL,
+    estimatedtime REAL,
+    deadtime REAL,
+    title TEXT,
+    user TEXT,
+    scandir TEXT,
+    scanfile TEXT,
+    endstatus TEXT,
+    channels TEXT,
+    PRIMARY KEY (serialno, startts)
+);
+CREATE INDEX IF NOT EXISTS scans_startts ON scans (startts);
+CREATE INDEX IF NOT EXISTS scans_title ON scans (title);
+CREATE TABLE IF NOT EXISTS profiles (
+    serialno INTEGER,
+    stamp REAL,
+    phases TEXT
+);
+CREATE INDEX IF NOT EXISTS profiles_stamp ON profiles (stamp);
+CREATE TABLE IF NOT EXISTS sync_dirs (
+    scandir TEXT PRIMARY KEY,
+    indexed REAL
+);
+CREATE TABLE IF NOT EXISTS sync_files (
+    scandir TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    hash TEXT,
+    synced INTEGER,
+    PRIMARY KEY (scandir, path)
+);
+"""
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def connect(path):
+    """Shared connection to the history database at path."""
+    with _lock:
+        conn = _connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.executescript(SCHEMA)
+            _connections[path] = conn
+        return conn
+
+
+def history_db(macro):
+    try:
+        return macro.getEnv("ScanHistoryDB")
+    except:
+        return HISTORY_DB
+
+
+def archive(conn, entries):
+    """Append ScanHistory entries not stored yet, return how many were new."""
+    rows = [
+        (
+            entry.get("serialno"),
+            entry.get("startts"),
+            entry.get("endts"),
+            entry.get("estimatedtime"),
+            entry.get("deadtime"),
+            entry.get("title"),
+            entry.get("user"),
+            entry.get("ScanDir"),
+            json.dumps(entry.get("ScanFile")),
+            entry.get("endstatus"),
+            json.dumps(entry.get("channels")),
+        )
+        for entry in entries
+    ]
+    with _lock, conn:
+        before = conn.total_changes
+        conn.executemany(
+            "INSERT OR IGNORE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        return conn.total_changes - before
+
+
+def archive_history(macro):
+    """Store the scans of the ScanHistory env in the history database.
+
+    The env keeps only the last scans (a ring buffer maintained by the
+    MacroServer); everything older lives in the database.
+    """
+    try:
+        entries = macro.getEnv("ScanHistory")
+    except:
+        return 0
+    return archive(connect(history_db(macro)), entries)
+
+
+def store_profile(conn, serialno, phases, stamp=None):
+    """Store the phase durations of the scan serialno (see profiling)."""
+    with _lock, conn:
+        conn.execute(
+            "INSERT INTO profiles VALUES (?, ?, ?)",
+            (serialno, time.time() if stamp is None else stamp, json.dumps(phases)),
+        )
+
+
+def recent_profiles(conn, limit):
+    """The last limit profiles as (serialno, stamp, phases), oldest first."""
+    with _lock:
+        rows = conn.execute(
+            "SELECT serialno, stamp, phases FROM profiles"
+            " ORDER BY stamp DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+    rows.reverse()
+    return [(serialno, stamp, json.loads(phases)) for serialno, stamp, phases in rows]
+
+
+def scan_of_profile(conn, serialno, stamp):
+    """(title, deadtime) of the scan serialno that ended before stamp."""
+    with _lock:
+        return conn.execute(
+            "SELECT title, deadtime FROM scans WHERE serialno = ? AND startts <= ?"
+            " ORDER BY startts DESC LIMIT 1",
+            (serialno, stamp),
+        ).fetchone()
+
+
+def sync_indexed(conn, scan_dir):
+    """Whether sync_data has indexed scan_dir (see sync_index)."""
+    with _lock:
+        row = conn.execute(
+            "SELECT 1 FROM sync_dirs WHERE scandir = ?", (scan_dir,)
+        ).fetchone()
+    return row is not None
+
+
+def sync_index(conn, scan_dir, files):
+    """Replace the sync manifest of scan_dir.
+
+    files maps paths relative to scan_dir to [size, mtime, hash, synced].
+    """
+    rows = [
+        (scan_dir, path, size, mtime, digest, int(synced))
+        for path, (size, mtime, digest, synced) in files.items()
+    ]
+    with _lock, conn:
+        conn.execute("DELETE FROM sync_files WHERE scandir = ?", (scan_dir,))
+        conn.executemany("INSERT INTO sync_files VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_dirs VALUES (?, ?)", (scan_dir, time.time())
+        )
+
+
+def sync_register(conn, scan_dir, entries):
+    """Mark (path, size, mtime) entries of an indexed scan_dir to be synced.
+
+    Files already in the manifest with the same size and mtime are kept.
+    """
+    rows = [(scan_dir, path, size, mtime, scan_dir) for path, size, mtime in entries]
+    with _lock, conn:
+        conn.executemany(
+            "INSERT INTO sync_files"
+            " SELECT ?, ?, ?, ?, NULL, 0 WHERE EXISTS"
+            " (SELECT 1 FROM sync_dirs WHERE scandir = ?)"
+            " ON CONFLICT (scandir, path) DO UPDATE"
+            " SET size = excluded.size, mtime = excluded.mtime, hash = NULL,"
+            " synced = 0"
+            " WHERE size != excluded.size OR mtime != excluded.mtime",
+            rows,
+        )
+
+
+def sync_pending(conn, scan_dir):
+    """Paths of scan_dir registered but not synced yet."""
+    with _lock:
+        rows = conn.execute(
+            "SELECT path FROM sync_files WHERE scandir = ? AND synced = 0",
+            (scan_dir,),
+        ).fetchall()
+    return [path for path, in rows]
+
+
+def sync_done(conn, scan_dir, paths):
+    with _lock, conn:
+        conn.executemany(
+            "UPDATE sync_files SET synced = 1 WHERE scandir = ? AND path = ?",
+            [(scan_dir, path) for path in paths],
+        )
+
+
+def sync_manifest(conn, scan_dir):
+    """The manifest of scan_dir, in the form taken by sync_index."""
+    with _lock:
+        rows = conn.execute(
+            "SELECT path, size, mtime, hash, synced FROM sync_files"
+            " WHERE scandir = ?",
+            (scan_dir,),
+        ).fetchall()
+    return dict(
+        (path, [size, mtime, digest, bool(synced)])
+        for path, size, mtime, digest, synced in rows
+    )
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    return time.mktime(datetime.fromisoformat(value).timetuple())
+
+
+def query(conn, title="", motor="", since=None, until=None, limit=20):
+    """The most recent scans matching all given filters, newest first.
+
+    title matches a part of the scan title, motor a whole word of it (the
+    title holds the scan command with its motors).
+    """
+    where, args = [], []
+    if title:
+        where.append("title LIKE ?")
+        args.append("%" + title + "%")
+    if motor:
+        where.append("(' ' || title || ' ') LIKE ?")
+        args.append("% " + motor + " %")
+    if since is not None:
+        where.append("startts >= ?")
+        args.append(since)
+    if until is not None:
+        where.append("startts < ?")
+        args.append(until)
+    sql = "SELECT serialno, startts, endts, deadtime, title, endstatus FROM scans"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY startts DESC LIMIT ?"
+    with _lock:
+        return conn.execute(sql, args + [limit]).fetchall()
+
+
+@macro(
+    [
+        ["title", Type.String, "", "part of the scan title"],
+        ["motor", Type.String, "", "motor moved by the scan"],
+        ["since", Type.String, "", "start, e.g. 2026-01-22 or 2026-01-22T10:00"],
+        ["until", Type.String, "", "end, same format as since"],
+        ["nb_scans", Type.Integer, 20, "maximum number of scans"],
+    ]
+)
+def history_query(self, title, motor, since, until, nb_scans):
+    """Macro history_query
+
+    Search all archived scans, not only the ones in the ScanHistory env.
+    """
+    archive_history(self)
+    rows = query(
+        connect(history_db(self)),
+        title,
+        motor,
+        _parse_time(since),
+        _parse_time(until),
+        nb_scans,
+    )
+    self.output(
+        "%8s %-19s %9s %9s %-8s %s",
+        "scan",
+        "start",
+        "duration",
+        "deadtime",
+        "status",
+        "title",
+    )
+    for serialno, startts, endts, deadtime, title, endstatus in rows:
+        self.output(
+            "%8s %-19s %9.1f %9.1f %-8s %s",
+            serialno,
+            datetime.fromtimestamp(startts).strftime("%Y-%m-%d %H:%M:%S"),
+            (endts or startts) - startts,
+            deadtime or 0.0,
+            endstatus,
+            title,
+        )
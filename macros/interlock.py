@@ -0,0 +1,119 @@
+import threading
+import time
+
+import tango
+
+from health import get_proxy
+
+PUMP_SHUTTER = "laser/ThorlabsMFF100/pump"
+# the pump shutter is closed while any of these motors moves
+INTERLOCK_MOTORS = frozenset(["h", "k", "l", "th", "tth", "q", "thc"])
+# mffstate of the flip mount, any other value means it is moving
+CLOSED = 0
+OPEN = 1
+
+
+class PumpShutter(object):
+    """Cached state of the pump shutter flip mount.
+
+    The mffstate attribute is followed through change events, so the hooks
+    read it without a Tango call. Without events the attribute is read when
+    the cache is older than max_age.
+    """
+
+    def __init__(self, device=PUMP_SHUTTER, max_age=0.5):
+        self.device = device
+        self.max_age = max_age
+        self._cond = threading.Condition()
+        self._state = None
+        self._stamp = 0.0
+        self._event_id = None
+        self.auto_closed = False
+
+    def _subscribe(self):
+        if self._event_id is not None:
+            return
+        try:
+            self._event_id = get_proxy(self.device).subscribe_event(
+                "mffstate", tango.EventType.CHANGE_EVENT, self._event
+            )
+        except tango.DevFailed:
+            # no change events configured, fall back to reading
+            self._event_id = False
+
+    def _event(self, event):
+        if event.err or event.attr_value is None:
+            with self._cond:
+                self._stamp = 0.0
+            return
+        self._update(event.attr_value.value)
+
+    def _update(self, state):
+        with self._cond:
+            self._state = state
+            self._stamp = time.time()
+            self._cond.notify_all()
+
+    def invalidate(self):
+        """Read the state again, e.g. after commanding the flip mount."""
+        with self._cond:
+            self._stamp = 0.0
+
+    def state(self, max_age=None):
+        if max_age is None:
+            max_age = self.max_age
+        self._subscribe()
+        with self._cond:
+            if self._event_id and self._stamp:
+                return self._state
+            if time.time() - self._stamp < max_age:
+                return self._state
+        self._update(get_proxy(self.device).read_attribute("mffstate").value)
+        return self._state
+
+    def wait_settled(self, timeout=5.0):
+        """The state once the flip mount stopped moving, at most timeout s."""
+        deadline = time.time() + timeout
+        state = self.state()
+        while state not in (CLOSED, OPEN):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError(
+                    "%s did not settle within %.1f s (mffstate %s)"
+                    % (self.device, timeout, state)
+                )
+            with self._cond:
+                # events wake up immediately, polling every 50 ms otherwise
+                self._cond.wait(min(remaining, 0.05))
+            state = self.state(max_age=0.0)
+        return state
+
+
+_shutter = None
+_scan_motors = {}
+
+
+def pump_shutter():
+    global _shutter
+    if _shutter is None:
+        _shutter = PumpShutter()
+    return _shutter
+
+
+def interlock_reset():
+    """Forget the motors of the previous scan (from user_pre_scan)."""
+    _scan_motors.clear()
+
+
+def needs_interlock(parent):
+    """Whether the scan parent moves any of the INTERLOCK_MOTORS.
+
+    Computed once per scan macro, not at every move.
+    """
+    key = id(parent)
+    if key not in _scan_motors:
+        _scan_motors.clear()
+        _scan_motors[key] = any(
+            mot.name.lower().strip() in INTERLOCK_MOTORS for mot in parent.motors
+        )
+    return _scan_motors[key]
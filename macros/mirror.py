@@ -0,0 +1,167 @@
+from sardana.macroserver.macro import macro
+import os
+import queue
+import subprocess
+import threading
+import time
+
+NAS_TARGET = "data_ampere@nasbsxr.sxr.lab:/share/Data/henryetta.sxr.lab/spectroscopy"
+RSYNC_ARGS = ["-r", "-t", "-g", "-s", "--out-format=%n"]
+
+
+class Mirror(object):
+    """Background mirroring of scan data to the NAS.
+
+    Sources are queued and transferred with rsync by a small pool of worker
+    threads, so the Door never waits for the network. A source that is
+    already queued is not queued again; rsync only transfers new or changed
+    files. A source is transferred by one worker at a time: queued again
+    while it is transferred, it is marked dirty and transferred once more
+    when the running transfer ends. Failed transfers are retried with an
+    increasing delay, and a transfer taking more than timeout s is killed.
+    Any error of a job is recorded in last_error, the workers never die.
+    """
+
+    def __init__(
+        self,
+        target=NAS_TARGET,
+        workers=2,
+        retries=3,
+        retry_delay=10.0,
+        timeout=3600.0,
+    ):
+        self.target = target
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._dirty = set()
+        self._running = {}
+        self.done = 0
+        self.failed = 0
+        self.files = 0
+        self.last_error = ""
+        self.last_duration = 0.0
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name="nas-mirror-%d" % i, daemon=True
+            )
+            thread.start()
+
+    def enqueue(self, source, filters=()):
+        """Queue source for mirroring, return False if it is already queued.
+
+        Raises ValueError if source is not an existing file or directory.
+        """
+        if not source or not os.path.exists(source):
+            raise ValueError("cannot mirror %r, no such file or directory" % source)
+        job = (source, tuple(filters))
+        with self._lock:
+            if job in self._pending or job in self._dirty:
+                return False
+            if source in self._running.values():
+                self._dirty.add(job)
+                return True
+            self._pending.add(job)
+        self._queue.put(job)
+        return True
+
+    def status(self):
+        with self._lock:
+            return {
+                "queued": len(self._pending) + len(self._dirty),
+                "running": dict(self._running),
+                "done": self.done,
+                "failed": self.failed,
+                "files": self.files,
+                "last_error": self.last_error,
+                "last_duration": self.last_duration,
+            }
+
+    def _rsync(self, source, filters):
+        """Transfer source once, return (success, files, error)."""
+        try:
+            result = subprocess.run(
+                ["rsync"] + RSYNC_ARGS + list(filters) + [source, self.target],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return False, 0, "rsync killed after %.0f s" % self.timeout
+        except OSError as e:
+            return False, 0, "rsync failed: %s" % e
+        if result.returncode != 0:
+            return False, 0, result.stderr.decode("utf-8", "replace").strip()
+        return True, len(result.stdout.splitlines()), ""
+
+    def _work(self):
+        name = threading.current_thread().name
+        while True:
+            job = self._queue.get()
+            source, filters = job
+            with self._lock:
+                self._pending.discard(job)
+                if source in self._running.values():
+                    # another worker transfers the same tree: run after it
+                    self._dirty.add(job)
+                    continue
+                self._running[name] = source
+            t0 = time.time()
+            try:
+                for attempt in range(self.retries + 1):
+                    if attempt:
+                        time.sleep(self.retry_delay * attempt)
+                    ok, files, error = self._rsync(source, filters)
+                    if ok:
+                        break
+            except Exception as e:
+                ok, files, error = False, 0, "%s: %s" % (type(e).__name__, e)
+            with self._lock:
+                del self._running[name]
+                self.last_duration = time.time() - t0
+                if ok:
+                    self.done += 1
+                    self.files += files
+                else:
+                    self.failed += 1
+                    self.last_error = "%s: %s" % (source, error)
+                again = [dirty for dirty in self._dirty if dirty[0] == source]
+                for dirty in again:
+                    self._dirty.discard(dirty)
+                    self._pending.add(dirty)
+                    self._queue.put(dirty)
+
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+
+def get_mirror():
+    """The mirroring service of this MacroServer, started on first use."""
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None:
+            _mirror = Mirror()
+        return _mirror
+
+
+@macro()
+def mirror_status(self):
+    """Macro mirror_status"""
+    status = get_mirror().status()
+    self.output(
+        "NAS mirror: %d queued | %d running | %d done | %d failed | %d files",
+        status["queued"],
+        len(status["running"]),
+        status["done"],
+        status["failed"],
+        status["files"],
+    )
+    for worker, source in status["running"].items():
+        self.output("%s: %s", worker, source)
+    self.output("last transfer took %.1f s", status["last_duration"])
+    if status["last_error"]:
+        self.warning("last error: %s", status["last_error"])
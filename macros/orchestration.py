@@ -0,0 +1,104 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+
+from sardana.macroserver.msexception import AbortException, StopException
+
+
+class Step(object):
+    """A step of a run_steps graph.
+
+    func is called without arguments after all steps in deps succeeded.
+    Steps that run macros (execMacro) must stay on the macro thread; only
+    steps with threaded set, e.g. plain Tango calls or motor moves, run in
+    the worker pool concurrently with the rest.
+    """
+
+    def __init__(self, name, func, deps=(), threaded=False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.threaded = threaded
+
+
+StepResult = namedtuple("StepResult", "name status duration error")
+
+
+def _timed_call(step):
+    t0 = time.time()
+    try:
+        step.func()
+    except (StopException, AbortException):
+        # the user stopped the macro: end run_steps, do not go on
+        raise
+    except Exception as e:
+        return StepResult(step.name, "failed", time.time() - t0, str(e) or repr(e))
+    return StepResult(step.name, "ok", time.time() - t0, "")
+
+
+def run_steps(steps, workers=4, check_point=None, poll_period=0.1):
+    """Run a dependency graph of steps, independent branches concurrently.
+
+    A step starts as soon as all its dependencies succeeded; the steps
+    depending on a failed step are skipped, which keeps safety orderings
+    such as laser before shutter. check_point (e.g. Macro.checkPoint) is
+    called between steps, and every poll_period s while only threaded steps
+    run, so that the caller can still be stopped or aborted; a stop or abort
+    raised by a step ends run_steps instead of counting as a failure.
+    Returns the StepResult of every step, in the order they finished.
+    """
+    pending = dict((step.name, step) for step in steps)
+    for step in steps:
+        for dep in step.deps:
+            if dep not in pending:
+                raise ValueError("%s depends on unknown step %s" % (step.name, dep))
+    status = {}
+    results = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            progressed = False
+            for future in [f for f in running if f.done()]:
+                del running[future]
+                result = future.result()
+                status[result.name] = result.status
+                results.append(result)
+                progressed = True
+            main = None
+            for name, step in list(pending.items()):
+                deps = [status.get(dep) for dep in step.deps]
+                if any(s is not None and s != "ok" for s in deps):
+                    del pending[name]
+                    status[name] = "skipped"
+                    results.append(StepResult(name, "skipped", 0.0, ""))
+                    progressed = True
+                elif all(s == "ok" for s in deps):
+                    if step.threaded:
+                        del pending[name]
+                        running[pool.submit(_timed_call, step)] = name
+                    elif main is None:
+                        # one macro step at a time, on the calling thread
+                        del pending[name]
+                        main = step
+            if main is not None:
+                if check_point is not None:
+                    check_point()
+                result = _timed_call(main)
+            elif running:
+                done, _ = wait(
+                    running, timeout=poll_period, return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    if check_point is not None:
+                        check_point()
+                    continue
+                future = done.pop()
+                del running[future]
+                result = future.result()
+            elif progressed:
+                continue
+            else:
+                raise ValueError("dependency cycle in %s" % ", ".join(pending))
+            status[result.name] = result.status
+            results.append(result)
+    return results
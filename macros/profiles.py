@@ -0,0 +1,158 @@
+from sardana.macroserver.macro import macro, Type
+import os
+
+import yaml
+
+from acquisition import ACQ_CONF_DEFAULTS, get_acq_conf, set_acq_conf
+from scans import PILC_TIMER
+
+PROFILES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "config", "profiles.yml"
+)
+PROFILE_KEYS = ("measurement_group", "trigger_mode", "acq_conf")
+
+
+def validate_profiles(profiles):
+    """List the errors of the profiles read from PROFILES_FILE."""
+    errors = []
+    if not isinstance(profiles, dict):
+        return ["profiles must be a mapping of profile names"]
+    for name, profile in profiles.items():
+        if not isinstance(profile, dict):
+            errors.append("%s: must be a mapping" % name)
+            continue
+        for key in profile:
+            if key not in PROFILE_KEYS:
+                errors.append("%s: unknown setting %s" % (name, key))
+        group = profile.get("measurement_group")
+        if group is not None and not isinstance(group, str):
+            errors.append("%s/measurement_group: must be a name" % name)
+        mode = profile.get("trigger_mode")
+        if mode is not None and (isinstance(mode, bool) or not isinstance(mode, int)):
+            errors.append("%s/trigger_mode: must be an integer" % name)
+        for key, value in (profile.get("acq_conf") or {}).items():
+            if key not in ACQ_CONF_DEFAULTS:
+                errors.append("%s/acq_conf: unknown entry %s" % (name, key))
+            elif isinstance(ACQ_CONF_DEFAULTS[key], bool):
+                if not isinstance(value, bool):
+                    errors.append("%s/acq_conf/%s: must be true or false" % (name, key))
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append("%s/acq_conf/%s: must be a number" % (name, key))
+            elif value < 0:
+                errors.append("%s/acq_conf/%s: must not be negative" % (name, key))
+    return errors
+
+
+_profiles = None
+_profiles_mtime = None
+
+
+def load_profiles(path=PROFILES_FILE):
+    """The validated profiles, read again only when the file changed."""
+    global _profiles, _profiles_mtime
+    mtime = os.path.getmtime(path)
+    if _profiles is None or mtime != _profiles_mtime:
+        with open(path) as f:
+            profiles = yaml.safe_load(f) or {}
+        errors = validate_profiles(profiles)
+        if errors:
+            raise ValueError("invalid %s:\n%s" % (path, "\n".join(errors)))
+        _profiles, _profiles_mtime = profiles, mtime
+    return _profiles
+
+
+@macro([["name", Type.String, None, "profile name, see profile_list"]])
+def profile_apply(self, name):
+    """Macro profile_apply
+
+    Switch to an acquisition profile of config/profiles.yml. Only the
+    settings that differ from the current state are written; if one of them
+    fails, the ones already written are restored.
+    """
+    profiles = load_profiles()
+    if name not in profiles:
+        raise ValueError(
+            "unknown profile %s, choose from %s" % (name, ", ".join(sorted(profiles)))
+        )
+    profile = profiles[name]
+
+    # collect the changes before writing anything
+    changes = []
+    group = profile.get("measurement_group")
+    if group is not None:
+        self.getObj(group, type_class=Type.MeasurementGroup)
+        current = self.getEnv("ActiveMntGrp")
+        if current != group:
+            changes.append(
+                (
+                    "ActiveMntGrp",
+                    current,
+                    group,
+                    lambda v: self.setEnv("ActiveMntGrp", v),
+                )
+            )
+    mode = profile.get("trigger_mode")
+    if mode is not None:
+        pilc = self.getController(PILC_TIMER)
+        current = pilc.read_attribute("triggermode").value
+        if current != mode:
+            changes.append(
+                (
+                    "%s.TriggerMode" % PILC_TIMER,
+                    current,
+                    mode,
+                    lambda v: pilc.write_attribute("triggermode", v),
+                )
+            )
+    acqConf = get_acq_conf(self).as_dict()
+    newConf = dict(acqConf)
+    newConf.update(profile.get("acq_conf") or {})
+    diff = sorted(key for key in newConf if newConf[key] != acqConf.get(key))
+    if diff:
+        changes.append(
+            (
+                "acqConf/" + ",".join(diff),
+                acqConf,
+                newConf,
+                lambda v: set_acq_conf(self, v),
+            )
+        )
+
+    done = []
+    try:
+        for change in changes:
+            setting, old, new, write = change
+            write(new)
+            done.append(change)
+    except:
+        for setting, old, new, write in reversed(done):
+            write(old)
+        self.warning("profile %s not applied, settings restored" % name)
+        raise
+    self.setEnv("AcqProfile", name)
+
+    if not changes:
+        self.output("profile %s is already active" % name)
+    for setting, old, new, write in changes:
+        if setting.startswith("acqConf/"):
+            for key in diff:
+                self.output("acqConf/%s: %s -> %s" % (key, old.get(key), new[key]))
+        else:
+            self.output("%s: %s -> %s" % (setting, old, new))
+
+
+@macro()
+def profile_list(self):
+    """Macro profile_list"""
+    try:
+        active = self.getEnv("AcqProfile")
+    except:
+        active = None
+    for name, profile in sorted(load_profiles().items()):
+        self.output(
+            "%s %-12s mntgrp=%s triggermode=%s",
+            "*" if name == active else " ",
+            name,
+            profile.get("measurement_group"),
+            profile.get("trigger_mode"),
+        )
@@ -0,0 +1,137 @@
+from sardana.macroserver.macro import macro, Type
+from contextlib import contextmanager
+import time
+
+import numpy as np
+
+from history import archive_history, connect, history_db, recent_profiles
+from history import scan_of_profile, store_profile
+
+
+class ScanProfile(object):
+    """Durations of the phases of one scan, one entry per occurrence."""
+
+    def __init__(self):
+        self.phases = {}
+        self.marks = {}
+
+    def add(self, phase, duration):
+        self.phases.setdefault(phase, []).append(duration)
+
+    def mark(self, name):
+        self.marks[name] = time.time()
+
+    def since(self, name, phase):
+        """Record the time since mark name as phase, if the mark is set."""
+        t0 = self.marks.pop(name, None)
+        if t0 is not None:
+            self.add(phase, time.time() - t0)
+
+
+_profile = ScanProfile()
+
+
+def profile():
+    """The profile of the running scan."""
+    return _profile
+
+
+def profile_start():
+    global _profile
+    _profile = ScanProfile()
+    return _profile
+
+
+@contextmanager
+def timed(phase):
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        _profile.add(phase, time.time() - t0)
+
+
+def exec_timed(macro, phase, name, *args):
+    """execMacro, recording its duration as <phase>/<name>."""
+    with timed("%s/%s" % (phase, name)):
+        return macro.execMacro(name, *args)
+
+
+def profile_finish(macro):
+    """Store the profile of the running scan in the scan history database.
+
+    Entries carry the serialno of the scan (its ScanID) to be matched with
+    the archived ScanHistory. The environment is not touched, so it does
+    not grow with the profiles.
+    """
+    try:
+        serialno = macro.getEnv("ScanID")
+    except:
+        serialno = None
+    phases = dict(
+        (phase, [round(d, 4) for d in durations])
+        for phase, durations in _profile.phases.items()
+    )
+    store_profile(connect(history_db(macro)), serialno, phases)
+
+
+@macro([["nb_scans", Type.Integer, 10, "number of recent scans"]])
+def deadtime_report(self, nb_scans):
+    """Macro deadtime_report
+
+    Percentiles of the duration of every profiled phase (hooks, macros run
+    by the hooks, settle time, motion and acquisition) over recent scans,
+    and the scan deadtime left unexplained by the hooks.
+    """
+    # the scan of the last profile enters ScanHistory after its hooks
+    archive_history(self)
+    conn = connect(history_db(self))
+    history = recent_profiles(conn, nb_scans)
+    if not history:
+        self.warning("No scan profiled yet, run a scan first")
+        return
+    durations = {}
+    for serialno, stamp, phases in history:
+        for phase, values in phases.items():
+            durations.setdefault(phase, []).extend(values)
+    self.output(
+        "%-36s %6s %9s %9s %9s %9s %9s",
+        "phase [s]",
+        "count",
+        "p50",
+        "p90",
+        "p99",
+        "max",
+        "total/scan",
+    )
+    for phase in sorted(durations, key=lambda p: -sum(durations[p])):
+        values = np.array(durations[phase])
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        self.output(
+            "%-36s %6d %9.4f %9.4f %9.4f %9.4f %9.4f",
+            phase,
+            len(values),
+            p50,
+            p90,
+            p99,
+            values.max(),
+            values.sum() / len(history),
+        )
+    self.output("")
+    self.output("%8s %-30s %9s %9s %9s", "scan", "title", "deadtime", "hooks", "other")
+    for serialno, stamp, phases in history:
+        scan = scan_of_profile(conn, serialno, stamp)
+        if scan is None or scan[1] is None:
+            continue
+        title, deadtime = scan
+        hooks = sum(
+            sum(values) for phase, values in phases.items() if phase.startswith("hook/")
+        )
+        self.output(
+            "%8d %-30s %9.3f %9.3f %9.3f",
+            serialno,
+            title[:30],
+            deadtime,
+            hooks,
+            deadtime - hooks,
+        )
@@ -1,4 +1,5 @@
 from sardana.macroserver.macro import Macro, macro, Type
+import json
 
 
 @macro([
@@ -18,3 +19,20 @@ def roi_read(self, roi_name, output):
         return []
 
 
+@macro([
+    ['channel', Type.ExpChannel, None, 'TangoVimba 2D channel reducing the ROIs'],
+    ['frame_output', Type.Boolean, True, 'also record the full frames']
+])
+def roi_apply(self, channel, frame_output):
+    """Macro roi_apply
+
+    Send the ROIs of the DetectorROIs environment variable to a TangoVimba
+    channel, which then reduces them on every frame for its ROI counters.
+    """
+    rois = self.getEnv('DetectorROIs')
+    channel.write_attribute('ROIs', json.dumps(rois))
+    channel.write_attribute('FrameOutput', frame_output)
+    self.output('{:d} ROIs applied to {:s}: {:s}'.format(
+        len(rois), channel.getName(), ', '.join(sorted(rois))))
+    if not frame_output:
+        self.warning('Full frames of {:s} are not recorded'.format(channel.getName()))
@@ -1,11 +1,20 @@
-from sardana.macroserver.macro import Macro, macro, Type
+from sardana.macroserver.macro import Hookable, Macro, macro, Type, Optional
+from sardana.macroserver.scan import SScan, ColumnDesc
 import os
+import hashlib
+import shutil
+import threading
 from dirsync import sync
 import tango
 import time
 
 import numpy as np
 
+from acquisition import get_acq_conf, set_acq_conf
+from calibration import WAVEPLATE, get_calibration, travel_order
+from history import connect, history_db, sync_done, sync_index, sync_indexed
+from history import sync_manifest, sync_pending, sync_register
+
 
 @macro([["integ_time", Type.Float, 0.05, "integration time in [s]"]])
 def acquire(self, integ_time):
@@ -33,6 +42,224 @@ def lup(self, motor, start_pos, final_pos, nr_interv, integ_time):
     self.execMacro(["dscan", motor, start_pos, final_pos, nr_interv, integ_time])
 
 
+class fluencescan(Macro, Hookable):
+    """Fluence series driven by the pump waveplate.
+
+    The waveplate angles of all points are computed up front from the
+    power/fluence calibration (see fluenceconf) and visited in one sweep,
+    starting from the end closest to the current waveplate position; the
+    fluence of every point is recorded in the fluence column. With
+    continuous set, the waveplate moves once through the whole range with
+    ascanct and the acquisitions are triggered on the fly. ascanct only
+    triggers on an equidistant angle grid, which does not match the
+    requested fluences: its spacing is the finest one of the requested
+    angles, so every requested fluence has a point within half a step, and
+    the fluences of the grid points are stored in the env variable
+    FluenceScanFluences."""
+
+    hints = {
+        "scan": "fluencescan",
+        "allowsHooks": (
+            "pre-scan",
+            "pre-move",
+            "post-move",
+            "pre-acq",
+            "post-acq",
+            "post-step",
+            "post-scan",
+        ),
+    }
+    param_def = [
+        ["start_fluence", Type.Float, None, "Scan start fluence [mJ/cm^2]"],
+        ["final_fluence", Type.Float, None, "Scan final fluence [mJ/cm^2]"],
+        ["nr_interv", Type.Integer, None, "Number of scan intervals"],
+        ["integ_time", Type.Float, None, "Integration time"],
+        ["continuous", Type.Boolean, False, "sweep the waveplate with ascanct"],
+    ]
+
+    def prepare(
+        self, start_fluence, final_fluence, nr_interv, integ_time, continuous, **opts
+    ):
+        self.integ_time = integ_time
+        self.continuous = continuous
+        self.waveplate = self.getMoveable(WAVEPLATE)
+        self.motors = [self.waveplate]
+        fluences = np.linspace(start_fluence, final_fluence, nr_interv + 1)
+        calibration = get_calibration()
+        warning = calibration.power_warning()
+        if warning:
+            self.warning(warning)
+        angles = calibration.angle(fluences)
+        order = travel_order(angles, self.waveplate.getPosition())
+        self.fluences = fluences[order]
+        self.angles = angles[order]
+        if not continuous:
+            env = opts.get("env", {})
+            extrainfodesc = [ColumnDesc(name="fluence", label="fluence")]
+            self._gScan = SScan(
+                self, self._generator, self.motors, env, [], extrainfodesc
+            )
+
+    def _generator(self):
+        step = {}
+        step["integ_time"] = self.integ_time
+        step["pre-move-hooks"] = self.getHooks("pre-move")
+        step["post-move-hooks"] = self.getHooks("post-move")
+        step["pre-acq-hooks"] = self.getHooks("pre-acq")
+        step["post-acq-hooks"] = self.getHooks("post-acq") + self.getHooks(
+            "_NOHINTS_"
+        )
+        step["post-step-hooks"] = self.getHooks("post-step")
+        step["check_func"] = []
+        for point_id, (angle, fluence) in enumerate(zip(self.angles, self.fluences)):
+            step["positions"] = [angle]
+            step["point_id"] = point_id
+            step["extrainfo"] = {"fluence": fluence}
+            yield step
+
+    def run(self, *args):
+        if not self.continuous:
+            for step in self._gScan.step_scan():
+                yield step
+            return
+        # the finest spacing of the requested points sets the trigger grid
+        start, final = self.angles[0], self.angles[-1]
+        spacing = np.min(np.abs(np.diff(self.angles)), initial=np.inf)
+        if np.isfinite(spacing) and spacing > 0:
+            nr_interv = int(np.ceil(abs(final - start) / spacing))
+        else:
+            nr_interv = 1
+        fluences = get_calibration().fluence(np.linspace(start, final, nr_interv + 1))
+        self.output(
+            "sweeping %s from %.3f to %.3f deg in %d intervals (%.3f to %.3f mJ/cm^2)",
+            WAVEPLATE,
+            start,
+            final,
+            nr_interv,
+            fluences[0],
+            fluences[-1],
+        )
+        self.execMacro(
+            "ascanct", self.waveplate, start, final, nr_interv, self.integ_time
+        )
+        self.setEnv("FluenceScanFluences", fluences.tolist())
+
+
+PILC_TIMER = "PiLCTimerCtrl_spec"
+
+
+class PositionLog(object):
+    """Positions of a moveable sampled with their time in a thread."""
+
+    def __init__(self, moveable, period=0.02):
+        self.moveable = moveable
+        self.period = period
+        self.times = []
+        self.positions = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            position = self.moveable.getPosition(force=True)
+            self.times.append(time.time())
+            self.positions.append(position)
+            self._stop.wait(self.period)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def interpolate(self, times):
+        return np.interp(times, self.times, self.positions)
+
+
+@macro(
+    [
+        ["start_pos", Type.Float, None, "Scan start delay"],
+        ["final_pos", Type.Float, None, "Scan final delay"],
+        ["nr_interv", Type.Integer, None, "Number of scan intervals"],
+        ["integ_time", Type.Float, None, "Integration time"],
+        ["latency_time", Type.Float, 0, "Latency time between the points"],
+        ["trigger_mode", Type.Integer, Optional, "PiLC TriggerMode during the scan"],
+    ]
+)
+def delayscanct(
+    self, start_pos, final_pos, nr_interv, integ_time, latency_time, trigger_mode
+):
+    """continuous scan of the delay pseudo motor.
+    The delay_stage moves at constant velocity through the whole range while
+    the acquisitions are gated on the fly (ascanct), instead of a move and
+    settle per point. trigger_mode sets PiLCTimerCtrl_spec.TriggerMode for
+    the scan and is restored afterwards. The delay is sampled during the
+    motion. The timestamps of ascanct are theoretical (computed from the
+    synchronization, not measured), so the delay of every point is only
+    interpolated if the env variable DelayScanTimeChannel names a channel of
+    the measurement group that measures the epoch of every acquisition
+    (e.g. an epoch counter gated by the PiLC). The interpolated delays, or
+    else the sampled delays with their epochs, are stored in the env
+    variable DelayScanPositions."""
+    pilc = self.getController(PILC_TIMER)
+    previous_mode = pilc.read_attribute("triggermode").value
+    if trigger_mode is not None:
+        pilc.write_attribute("triggermode", trigger_mode)
+
+    delay = self.getMoveable("delay")
+    log = PositionLog(delay)
+    log.start()
+    try:
+        scan = self.execMacro(
+            "ascanct", delay, start_pos, final_pos, nr_interv, integ_time, latency_time
+        )
+    finally:
+        log.stop()
+        if trigger_mode is not None:
+            pilc.write_attribute("triggermode", previous_mode)
+
+    serialno = self.getEnv("ScanID")
+    column = None
+    try:
+        channel = self.getEnv("DelayScanTimeChannel")
+    except:
+        channel = None
+    if channel:
+        for desc in scan._gScan._env["datadesc"]:
+            if channel in (desc.label, desc.name) or desc.name.endswith("/" + channel):
+                column = desc.name
+                break
+        else:
+            self.warning("DelayScanTimeChannel %s is not measured by the scan", channel)
+    if column is None:
+        self.setEnv(
+            "DelayScanPositions",
+            {"serialno": serialno, "epoch": log.times, "delay": log.positions},
+        )
+        self.output(
+            "no measured acquisition times, %d sampled delays stored in "
+            "DelayScanPositions",
+            len(log.times),
+        )
+        return
+    times = [record.data.get(column) for record in scan.data.records]
+    delays = log.interpolate(
+        np.array([np.nan if t is None else t for t in times], dtype=float)
+    )
+    self.setEnv(
+        "DelayScanPositions",
+        {"serialno": serialno, "delay": delays.tolist()},
+    )
+    self.output(
+        "%d points, delays %.4f to %.4f interpolated at %s (see DelayScanPositions)",
+        len(delays),
+        np.nanmin(delays) if len(delays) else np.nan,
+        np.nanmax(delays) if len(delays) else np.nan,
+        channel,
+    )
+
+
 @macro()
 def custom_snapshot(self):
     """add some custom comments to the snapshots.
@@ -54,14 +281,121 @@ def custom_snapshot(self):
         self.output("Its not a scan")
 
 
-@macro()
-def sync_data(self):
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def manifest_register(macro, scan_dir, paths):
+    """Mark files written by a scan for the next sync_data.
+
+    Only paths are stat'ed. The manifest is kept in the scan history
+    database, outside ScanDir, so it is not mirrored itself; until the first
+    sync_data has indexed scan_dir nothing is recorded.
+    """
+    entries = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((os.path.relpath(path, scan_dir), st.st_size, st.st_mtime))
+    sync_register(connect(history_db(macro)), scan_dir, entries)
+
+
+def _walk(scan_dir):
+    for root, dirs, files in os.walk(scan_dir):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+def manifest_update(scan_dir, files):
+    """Mark the files of scan_dir that are new or changed since the manifest.
+
+    Walks scan_dir and stats every local file, nothing is hashed or read
+    from the remote side; entries of files deleted locally are dropped.
+    Returns the number of files to copy.
+    """
+    seen = set()
+    for path in _walk(scan_dir):
+        st = os.stat(path)
+        rel = os.path.relpath(path, scan_dir)
+        seen.add(rel)
+        entry = files.get(rel)
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime]:
+            files[rel] = [st.st_size, st.st_mtime, None, False]
+    for rel in set(files) - seen:
+        del files[rel]
+    return sum(1 for entry in files.values() if not entry[3])
+
+
+@macro([["verify", Type.Boolean, False, "compare hashes with RemoteScanDir"]])
+def sync_data(self, verify):
+    """Copy new or changed files of ScanDir to RemoteScanDir.
+
+    Only the files registered by user_post_scan since the last sync are
+    copied, without walking ScanDir or reading the remote side. The first
+    run compares everything with dirsync. verify walks ScanDir, so it also
+    copies the files written outside the scans (detector or value reference
+    files), and hashes the files whose size matches the remote copy.
+    """
     ScanDir = self.getEnv("ScanDir")
     RemoteScanDir = self.getEnv("RemoteScanDir")
 
     if os.path.exists(RemoteScanDir):
         self.info("Syncing data from %s to %s", ScanDir, RemoteScanDir)
-        sync(ScanDir, RemoteScanDir, "sync", create=True)
+        conn = connect(history_db(self))
+        if not sync_indexed(conn, ScanDir):
+            # first run: full comparison, then index what is now in sync
+            sync(ScanDir, RemoteScanDir, "sync", create=True)
+            files = {}
+            for path in _walk(ScanDir):
+                st = os.stat(path)
+                rel = os.path.relpath(path, ScanDir)
+                files[rel] = [st.st_size, st.st_mtime, None, True]
+            sync_index(conn, ScanDir, files)
+            return
+        if not verify:
+            pending = sync_pending(conn, ScanDir)
+            copied = []
+            for rel in pending:
+                remote = os.path.join(RemoteScanDir, rel)
+                os.makedirs(os.path.dirname(remote), exist_ok=True)
+                try:
+                    shutil.copy2(os.path.join(ScanDir, rel), remote)
+                except FileNotFoundError:
+                    # deleted since the scan, dropped by the next verify
+                    continue
+                copied.append(rel)
+            sync_done(conn, ScanDir, copied)
+            self.info("%d of %d registered files copied", len(copied), len(pending))
+            return
+        files = sync_manifest(conn, ScanDir)
+        manifest_update(ScanDir, files)
+        for rel, entry in files.items():
+            path = os.path.join(ScanDir, rel)
+            remote = os.path.join(RemoteScanDir, rel)
+            if not os.path.exists(remote):
+                entry[3] = False
+            elif os.path.getsize(remote) != entry[0]:
+                entry[3] = False
+            else:
+                entry[2] = entry[2] or _file_hash(path)
+                entry[3] = entry[2] == _file_hash(remote)
+        copied = 0
+        for rel, entry in files.items():
+            if entry[3]:
+                continue
+            remote = os.path.join(RemoteScanDir, rel)
+            os.makedirs(os.path.dirname(remote), exist_ok=True)
+            shutil.copy2(os.path.join(ScanDir, rel), remote)
+            entry[3] = True
+            copied += 1
+        sync_index(conn, ScanDir, files)
+        self.info("%d of %d files copied", copied, len(files))
     else:
         self.warning(
             "RemoteScanDir %s does not exist - no folder syncing", RemoteScanDir
@@ -81,10 +415,42 @@ def snap(self, integ_time):
 
 
 
+@macro(
+    [
+        ["channel", Type.ExpChannel, None, "TangoVimba 2D channel"],
+        ["integ_time", Type.Float, 0.05, "integration time in [s]"],
+        ["mode", Type.String, "dark", "laser mode of the dark"],
+        ["force", Type.Boolean, False, "take a dark even if the cached one is valid"],
+    ]
+)
+def dark_update(self, channel, integ_time, mode, force):
+    """Macro dark_update
+
+    Make sure the dark library of a TangoVimba channel holds a valid dark for
+    integ_time and mode, taking one with dark_image_acquire only when it is
+    missing or older than the DarkMaxAge of the controller. The channel
+    subtracts it on the fly from then on (DarkSubtraction).
+    """
+    channel.write_attribute("DarkMode", mode)
+    channel.write_attribute("DarkExposure", integ_time)
+    age = channel.read_attribute("DarkAge").value
+    if age >= 0 and not force:
+        self.output("dark of %s is %.0f s old, not taken again", channel.getName(), age)
+    else:
+        channel.write_attribute("DarkRecord", True)
+        try:
+            self.execMacro("dark_image_acquire", integ_time)
+        finally:
+            # averages the recorded frames into the library
+            channel.write_attribute("DarkRecord", False)
+        self.output("dark of %s updated", channel.getName())
+    channel.write_attribute("DarkSubtraction", True)
+
+
 @macro([["integ_time", Type.Float, 0.05, "integration time in [s]"]])
 def dark_image_pump(self, integ_time):
     """Macro to acquire a dark image with the pump on"""
-    acqConf = self.getEnv("acqConf")
+    acqConf = get_acq_conf(self).as_dict()
     acqConf_before = acqConf.copy()
 
     acqConf["checkTape"] = False
@@ -97,17 +463,17 @@ def dark_image_pump(self, integ_time):
     acqConf["darkModeLaser"] = True
     acqConf["autoShutterPump"] = False
 
-    self.setEnv("acqConf", acqConf)
+    set_acq_conf(self, acqConf)
 
     self.execMacro("timescan", "0", "{:0.3f}".format(integ_time), "0.2")
 
-    self.setEnv("acqConf", acqConf_before)
+    set_acq_conf(self, acqConf_before)
 
 
 @macro([["integ_time", Type.Float, 0.05, "integration time in [s]"]])
 def dark_image_acquire(self, integ_time):
     """Macro to acquire a dark image with the pump on"""
-    acqConf = self.getEnv("acqConf")
+    acqConf = get_acq_conf(self).as_dict()
     acqConf_before = acqConf.copy()
 
     acqConf["checkTape"] = False
@@ -120,12 +486,12 @@ def dark_image_acquire(self, integ_time):
     acqConf["darkModeLaser"] = True
     acqConf["autoShutterPump"] = False
 
-    self.setEnv("acqConf", acqConf)
+    set_acq_conf(self, acqConf)
 
     self.execMacro("user_pre_scan")
     self.execMacro("user_pre_acq")
     self.execMacro("ct", "{:0.3f}".format(integ_time))
 
-    self.setEnv("acqConf", acqConf_before)
+    set_acq_conf(self, acqConf_before)
 
     self.execMacro("user_post_scan")
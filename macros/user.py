@@ -1,80 +1,86 @@
 from sardana.macroserver.macro import Macro, macro, Type
-from time import sleep
-from tango import DeviceProxy
+from time import sleep, time
 
 from dirsync import sync
 import os
-import subprocess
+
+from acquisition import get_acq_conf, load_acq_conf, mark_motion_end, settle_deadline
+from acquisition import register_post_move_hook
+from health import PRESSURE_GAUGES, run_checks
+from history import archive_history
+from interlock import CLOSED, OPEN, interlock_reset, needs_interlock, pump_shutter
+from mirror import get_mirror
+from profiling import exec_timed, profile, profile_start, profile_finish, timed
+from scans import manifest_register
 
 
 @macro()
 def user_pre_acq(self):
     """Macro user_pre_acq"""
-
-    acqConf = self.getEnv("acqConf")
-    try:
-        waittime = acqConf["waitTime"]
-    except:
-        self.warning("env variable acqConf/waitTime not found!")
-        waittime = 0
-
-    try:
-        check_tape = acqConf["checkTape"]
-    except:
-        self.warning("env variable acqConf/checkTape not found!")
-        check_tape = False
-
-    try:
-        check_cam_temp = acqConf["checkCamTemp"]
-    except:
-        self.warning("env variable acqConf/checkCamTemp not found!")
-        check_cam_temp = False
-
-    if check_tape:
-        self.execMacro("tape_check")
-
-    if check_cam_temp:
-        self.execMacro("ccd_check")
-
-    if waittime > 0:
-        sleep(waittime)
-        self.debug("waiting for %.2f s", waittime)
+    t0 = time()
+    prof = profile()
+    prof.since("pre_acq_end", "acquisition")
+    prof.since("post_move_end", "post_move->pre_acq")
+    prof.since("pre_scan_end", "pre_scan->pre_acq")
+
+    acqConf = get_acq_conf(self)
+    waittime = acqConf.waitTime
+    # the settle time runs since the end of the motion, the checks below
+    # overlap with it instead of adding to it
+    deadline = settle_deadline(waittime)
+
+    if acqConf.checkTape:
+        exec_timed(self, "user_pre_acq", "tape_check")
+
+    if acqConf.checkCamTemp:
+        exec_timed(self, "user_pre_acq", "ccd_check")
+
+    if acqConf.checkPressure:
+        with timed("user_pre_acq/pressure"):
+            failed = [r for r in run_checks(PRESSURE_GAUGES, max_age=5.0) if not r.ok]
+        if failed:
+            raise RuntimeError(
+                "pressure interlock: "
+                + ", ".join("%s %s" % (r.name, r.error or r.value) for r in failed)
+            )
+
+    remaining = deadline - time()
+    if remaining > 0:
+        with timed("user_pre_acq/settle"):
+            sleep(remaining)
+        self.debug("waiting for %.2f s of %.2f s", remaining, waittime)
+
+    prof.add("hook/user_pre_acq", time() - t0)
+    prof.mark("pre_acq_end")
 
 
 @macro()
 def user_pre_scan(self):
     """Macro user_pre_scan"""
-    acqConf = self.getEnv("acqConf")
+    t0 = time()
+    prof = profile_start()
+    # one snapshot per scan, shared by all the hooks of the scan
+    acqConf = load_acq_conf(self)
+    interlock_reset()
+    if acqConf.waitTime > 0:
+        # the settle time runs from the motion end marked by user_post_move
+        register_post_move_hook(self)
 
-    try:
-        start_tape = acqConf["startTape"]
-    except:
-        self.warning("env variable acqConf/startTape not found!")
-    if start_tape:
-        self.execMacro("tape_on")
+    if acqConf.startTape:
+        exec_timed(self, "user_pre_scan", "tape_on")
 
-    try:
-        start_target = acqConf["startTarget"]
-    except:
-        self.warning("env variable acqConf/startTarget not found!")
-    if start_tape:
-        self.execMacro("target_on")
+    if acqConf.startTarget:
+        exec_timed(self, "user_pre_scan", "target_on")
 
-    try:
-        dark_mode_laser = acqConf["darkModeLaser"]
-    except:
-        self.warning("env variable acqConf/darkModeLaser not found!")
-    if dark_mode_laser:
-        self.execMacro("laser_dark_mode")
-    else:
-        try:
-            auto_mode_laser = acqConf["autoModeLaser"]
-        except:
-            self.warning("env variable acqConf/autoModeLaser not found!")
-        if auto_mode_laser:
-            self.execMacro("laser_scan_mode")
+    if acqConf.darkModeLaser:
+        exec_timed(self, "user_pre_scan", "laser_dark_mode")
+    elif acqConf.autoModeLaser:
+        exec_timed(self, "user_pre_scan", "laser_scan_mode")
+
+    exec_timed(self, "user_pre_scan", "acqrep")
 
-    self.execMacro("acqrep")
+    prof.add("hook/user_pre_scan", time() - t0)
+    prof.mark("pre_scan_end")
 
 
 # @macro()
@@ -94,34 +100,40 @@ def user_pre_scan(self):
 @macro()
 def user_post_scan(self):
     """Macro user_pre_scan"""
+    t0 = time()
+    prof = profile()
+    prof.since("pre_acq_end", "acquisition")
 
-    acqConf = self.getEnv("acqConf")
-
-    try:
-        stop_tape = acqConf["stopTape"]
-    except:
-        self.warning("env variable acqConf/stopTape not found!")
-        stop_tape = False
+    acqConf = get_acq_conf(self)
 
-    if stop_tape:
-        self.execMacro("tape_off")
+    if acqConf.stopTape:
+        exec_timed(self, "user_post_scan", "tape_off")
 
-    try:
-        stop_target = acqConf["stopTarget"]
-    except:
-        self.warning("env variable acqConf/stopTarget not found!")
-        stop_target = False
+    if acqConf.stopTarget:
+        exec_timed(self, "user_post_scan", "target_off")
 
-    if stop_target:
-        self.execMacro("target_off")
+    if acqConf.autoModeLaser:
+        exec_timed(self, "user_post_scan", "laser_ready_mode")
 
     try:
-        auto_mode_laser = acqConf["autoModeLaser"]
+        scan_dir = self.getEnv("ScanDir")
+        scan_files = self.getEnv("ScanFile")
     except:
-        self.warning("env variable acqConf/autoModeLaser not found!")
+        scan_dir, scan_files = None, []
+    if isinstance(scan_files, str):
+        scan_files = [scan_files]
+    if scan_dir:
+        # the files of this scan are copied by the next sync_data
+        manifest_register(
+            self, scan_dir, [os.path.join(scan_dir, f) for f in scan_files]
+        )
 
-    if auto_mode_laser:
-        self.execMacro("laser_ready_mode")
+    # the previous scans, this one enters ScanHistory only after the hooks
+    with timed("user_post_scan/history"):
+        archive_history(self)
+
+    prof.add("hook/user_post_scan", time() - t0)
+    profile_finish(self)
 
 
 @macro()
@@ -131,14 +143,15 @@ def user_post_scan_sync(self):
     #    sync_cmd = ["sshpass", "-p", "'cV4mBBpS2StpqBP'", "rsync", "-r", "-t", "-g", "-v", "--progress", "-s", "/home/labuser/Data", "data_ampere@nasbsxr.sxr.lab:/share/Data/henryetta.sxr.lab/spectroscopy"]
 
     if scanDir is not "" and scanDir is not None:
-        self.output("Mirroring on NAS initiated...")
-        result = subprocess.run(
-            f'rsync -r -t -g -v --progress -s --include="*_[0-9][0-9][0-9][0-9].h5" --exclude="*.h5" {scanDir} data_ampere@nasbsxr.sxr.lab:/share/Data/henryetta.sxr.lab/spectroscopy',
-            shell=True,
-            stdout=subprocess.PIPE,
-        )
-        self.output(result.stdout.decode("utf-8"))
-        self.output("End of mirroring.")
+        # transferred in the background, the next scan does not wait for it
+        try:
+            get_mirror().enqueue(
+                scanDir, ["--include=*_[0-9][0-9][0-9][0-9].h5", "--exclude=*.h5"]
+            )
+        except ValueError as e:
+            self.warning("Mirroring on NAS not queued: %s" % e)
+            return
+        self.output("Mirroring on NAS queued.")
     else:
         self.output("ScanDir is not set, please check the save path.")
 
@@ -158,34 +171,22 @@ def user_pre_move(self):
     """Macro user_pre_move"""
 
     # self.info('In user pre move')
+    t0 = time()
+    prof = profile()
+    prof.since("pre_acq_end", "acquisition")
 
-    acqConf = self.getEnv("acqConf")
-
-    try:
-        auto_shutter_pump = acqConf["autoShutterPump"]
-    except:
-        self.warning("env variable acqConf/autoShutterPump not found!")
-        auto_shutter_pump = False
-
-    if auto_shutter_pump:
+    if get_acq_conf(self).autoShutterPump:
         parent = self.getParentMacro()
-        if parent:
-            # check if we need to close the shutter or not
-            close_pump_shutter = False
-            for mot in parent.motors:
-                self.output(mot)
-                if mot.name.lower().strip() in ["h", "k", "l", "th", "tth", "q", "thc"]:
-                    close_pump_shutter = True
-            if close_pump_shutter:
-                # check if the pump shutter is open
-                proxy = DeviceProxy("laser/ThorlabsMFF100/pump")
-                mirror_state = proxy.mffstate
-                while mirror_state not in [0, 1]:
-                    sleep(0.1)
-                    mirror_state = proxy.mffstate
-                if mirror_state == 1:
-                    self.setEnv("autoClosePump", True)
-                    self.execMacro("pump_off")
+        if parent and needs_interlock(parent):
+            shutter = pump_shutter()
+            # consecutive moves leave a closed shutter alone
+            if shutter.wait_settled() == OPEN:
+                shutter.auto_closed = True
+                exec_timed(self, "user_pre_move", "pump_off")
+                shutter.invalidate()
+
+    prof.add("hook/user_pre_move", time() - t0)
+    prof.mark("pre_move_end")
 
 
 @macro()
@@ -193,41 +194,20 @@ def user_post_move(self):
     """Macro user_post_move"""
 
     # self.info('In user post move')
+    mark_motion_end()
+    t0 = time()
+    prof = profile()
+    prof.since("pre_move_end", "motion")
 
-    acqConf = self.getEnv("acqConf")
-
-    try:
-        auto_shutter_pump = acqConf["autoShutterPump"]
-    except:
-        self.warning("env variable acqConf/autoShutterPump not found!")
-        auto_shutter_pump = False
-
-    if auto_shutter_pump:
+    if get_acq_conf(self).autoShutterPump:
         parent = self.getParentMacro()
-        if parent:
-            if self.getEnv("autoClosePump"):
-                # shutter was automatically close in pre-move
-                # check if we really need to open the shutter or not
-                open_pump_shutter = False
-                for mot in parent.motors:
-                    if mot.name.lower().strip() in [
-                        "h",
-                        "k",
-                        "l",
-                        "th",
-                        "tth",
-                        "q",
-                        "thc",
-                    ]:
-                        open_pump_shutter = True
-
-                if open_pump_shutter:
-                    # check if the pump shutter is closed
-                    proxy = DeviceProxy("laser/ThorlabsMFF100/pump")
-                    mirror_state = proxy.mffstate
-                    while mirror_state not in [0, 1]:
-                        sleep(0.1)
-                        mirror_state = proxy.mffstate
-                    if mirror_state == 0:
-                        self.setEnv("autoClosePump", False)
-                        self.execMacro("pump_on")
+        shutter = pump_shutter()
+        # only reopen a shutter closed in user_pre_move
+        if parent and shutter.auto_closed and needs_interlock(parent):
+            if shutter.wait_settled() == CLOSED:
+                exec_timed(self, "user_post_move", "pump_on")
+                shutter.invalidate()
+            shutter.auto_closed = False
+
+    prof.add("hook/user_post_move", time() - t0)
+    prof.mark("post_move_end")